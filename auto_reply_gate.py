@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import Counter
+
+
+class AutoReplyGate:
+    """Cheap local checks in front of the auto-reply decision call.
+
+    Every message is classified as one of:
+    - "direct": the bot was mentioned or replied to, so it should reply without asking the model first.
+    - "decide": worth a decision call, which is debounced per channel so a burst of messages costs one call.
+    - "skip": the bot spoke within the cooldown, or (with `require_trigger`) nothing suggests it should reply.
+    """
+
+    def __init__(self, cooldown=30.0, debounce=3.0, require_trigger=False):
+        self.cooldown = cooldown
+        self.debounce = debounce
+        self.require_trigger = require_trigger
+        self.counts = Counter()
+        self._last_spoke = {}
+        self._pending = {}
+        self._tasks = set()
+
+    def note_bot_message(self, channel_id):
+        """Record that the bot just spoke in a channel, starting its cooldown."""
+        now = time.monotonic()
+        self._last_spoke.pop(channel_id, None)
+        self._last_spoke[channel_id] = now
+        # Entries are in the order the bot spoke, so cooldowns that have run out are dropped from the front.
+        while self._last_spoke and now - next(iter(self._last_spoke.values())) >= self.cooldown:
+            del self._last_spoke[next(iter(self._last_spoke))]
+
+    def classify(self, message, bot_user):
+        """Classify a message as "direct", "decide" or "skip"."""
+        self.counts["messages"] += 1
+
+        reference = message.reference.resolved if message.reference is not None else None
+        replied_to_bot = getattr(getattr(reference, "author", None), "id", None) == bot_user.id
+        if replied_to_bot or any(user.id == bot_user.id for user in message.mentions):
+            self.counts["direct"] += 1
+            return "direct"
+
+        last_spoke = self._last_spoke.get(message.channel.id)
+        if last_spoke is not None and time.monotonic() - last_spoke < self.cooldown:
+            self.counts["skipped_cooldown"] += 1
+            return "skip"
+
+        content = message.clean_content.lower()
+        if "?" in content or bot_user.name.lower() in content:
+            self.counts["triggered"] += 1
+            return "decide"
+
+        if self.require_trigger:
+            self.counts["skipped_no_trigger"] += 1
+            return "skip"
+        return "decide"
+
+    def cancel(self, channel_id):
+        """Drop a channel's pending decision, if there is one."""
+        pending = self._pending.pop(channel_id, None)
+        if pending is not None and not pending.done():
+            pending.cancel()
+            self.counts["debounced"] += 1
+
+    def schedule(self, message, callback):
+        """Run `callback(message)` once the channel has been quiet for the debounce window.
+
+        A newer message in the same channel restarts the window and replaces the older one.
+        """
+        channel_id = message.channel.id
+        self.cancel(channel_id)
+        task = asyncio.create_task(self._debounce(message, callback))
+        self._pending[channel_id] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _debounce(self, message, callback):
+        await asyncio.sleep(self.debounce)
+        if self._pending.get(message.channel.id) is asyncio.current_task():
+            del self._pending[message.channel.id]
+        self.counts["decision_calls"] += 1
+        await callback(message)
+
+    def stats(self):
+        """Format the decision counters for display."""
+        if not self.counts:
+            return "No auto-reply decisions yet."
+        return "\n".join(f"{name}: {count}" for name, count in sorted(self.counts.items()))
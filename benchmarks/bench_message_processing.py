@@ -0,0 +1,198 @@
+"""Micro-benchmarks for the message_processing hot paths.
+
+Runs entirely offline against fake Discord objects and a stubbed OpenAI client, and reports latency and peak
+allocations for each function across a sweep of history depths, prompt budgets, encoding models and message
+lengths. tiktoken downloads its encoding files on first use; when they aren't cached (see TIKTOKEN_CACHE_DIR),
+an approximate stand-in encoding is used instead and the results are marked with a "fake-" encoding name.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_message_processing
+    python -m benchmarks.bench_message_processing --depths 20,100 --models gpt-4 --json results.json
+"""
+import argparse
+import asyncio
+import copy
+import inspect
+import itertools
+import json
+import statistics
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from benchmarks.fakes import (
+    FakeChannel,
+    FakeInteraction,
+    FakeUser,
+    StubAsyncOpenAI,
+    fake_channel_with_history,
+    load_encoding,
+    load_encoding_by_name,
+    random_text,
+)
+from context_window import ContextWindows
+from message_cache import MessageHistoryCache
+from message_processing import (
+    auto_prepare_message_history,
+    count_tokens,
+    generate_response,
+    prepare_message_history,
+    send_reply_chunks,
+)
+from settings import DEFAULT_SETTINGS
+from token_cache import TokenCountCache
+from tokenizer_pool import TokenizerPool
+
+
+def csv(kind):
+    return lambda value: [kind(item) for item in value.split(",")]
+
+
+async def measure(call, repeat):
+    """Time `repeat` calls and measure the peak allocation of one more. `call` may return an awaitable."""
+    async def once():
+        result = call()
+        if inspect.isawaitable(result):
+            await result
+
+    await once()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        await once()
+        timings.append(time.perf_counter_ns() - start)
+
+    tracemalloc.start()
+    try:
+        await once()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "mean_us": statistics.fmean(timings) / 1000,
+        "p50_us": timings[len(timings) // 2] / 1000,
+        "p95_us": timings[min(len(timings) - 1, int(len(timings) * 0.95))] / 1000,
+        "peak_kib": peak / 1024,
+    }
+
+
+async def bench_history(args, results):
+    client = SimpleNamespace(user=FakeChannel.bot_user)
+    # Every batch goes to the workers, to show what offloading costs and saves at each depth.
+    tokenizer = (TokenizerPool(args.tokenizer_processes, 0, load_encoding_by_name)
+                 if args.tokenizer_processes else None)
+    for model, depth, max_tokens, length in itertools.product(args.models, args.depths, args.max_tokens,
+                                                              args.lengths):
+        enc = load_encoding(model)
+        settings = copy.deepcopy(DEFAULT_SETTINGS)
+        settings["prompt_max_tokens"] = max_tokens
+        channel = fake_channel_with_history(depth, length)
+        interaction = FakeInteraction(channel, FakeUser("asker"), random_text(length))
+        message = channel.messages[-1]
+        params = {"model": model, "encoding": enc.name, "depth": depth, "prompt_max_tokens": max_tokens,
+                  "length": length}
+
+        # Cold: every build pages history from the channel and tokenizes every message again.
+        for name, function, trigger in (("prepare_message_history", prepare_message_history, interaction),
+                                        ("auto_prepare_message_history", auto_prepare_message_history, message)):
+            results.append({"function": name, "mode": "cold", **params, **await measure(
+                lambda: function(trigger, settings, enc, client), args.repeat)})
+            if tokenizer is not None:
+                results.append({"function": name, "mode": "pooled", **params, **await measure(
+                    lambda: function(trigger, settings, enc, client, tokenizer=tokenizer), args.repeat)})
+
+            history_cache = MessageHistoryCache(max(depth, 100))
+            token_cache = TokenCountCache()
+            results.append({"function": name, "mode": "cached", **params, **await measure(
+                lambda: function(trigger, settings, enc, client, history_cache, token_cache), args.repeat)})
+
+            # Windowed: the rendered history is kept between builds, so unchanged history isn't walked again.
+            context_windows = ContextWindows(max_tokens)
+            results.append({"function": name, "mode": "windowed", **params, **await measure(
+                lambda: function(trigger, settings, enc, client, history_cache, token_cache, context_windows),
+                args.repeat)})
+
+    if tokenizer is not None:
+        tokenizer.close()
+
+
+async def bench_count_tokens(args, results):
+    for model, length in itertools.product(args.models, args.lengths):
+        enc = load_encoding(model)
+        text = random_text(length)
+        results.append({"function": "count_tokens", "model": model, "encoding": enc.name, "length": length,
+                        **await measure(lambda: count_tokens(text, enc), args.repeat)})
+
+
+async def bench_chunking(args, results):
+    for length in args.reply_lengths:
+        reply = random_text(length)
+        channel = FakeChannel(keep_sent=False)
+        interaction = FakeInteraction(channel, FakeUser("asker"))
+        message = channel.add(FakeUser("author"), "hi")
+        results.append({"function": "send_reply_chunks", "length": length,
+                        **await measure(lambda: send_reply_chunks(interaction, reply), args.repeat)})
+        results.append({"function": "send_reply_chunks", "mode": "attachment", "length": length,
+                        **await measure(lambda: send_reply_chunks(message, reply, 1), args.repeat)})
+
+
+async def bench_generate(args, results):
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    channel = FakeChannel()
+    interaction = FakeInteraction(channel, FakeUser("asker"), "hello")
+    client = StubAsyncOpenAI()
+    history = [{"role": "system", "content": "system"}, {"role": "user", "content": "asker: hello"}]
+    results.append({"function": "generate_response", "mode": "stub",
+                    **await measure(lambda: generate_response(history, interaction, settings, client),
+                                    args.repeat)})
+
+
+def print_table(results):
+    columns = ["function", "mode", "model", "encoding", "depth", "prompt_max_tokens", "length", "mean_us", "p50_us",
+               "p95_us", "peak_kib"]
+    rows = [[_format(result.get(column, "")) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[index]) for row in rows)) for index, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def _format(value):
+    return f"{value:.1f}" if isinstance(value, float) else str(value)
+
+
+async def run(args):
+    results = []
+    await bench_count_tokens(args, results)
+    await bench_history(args, results)
+    await bench_chunking(args, results)
+    await bench_generate(args, results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--depths", type=csv(int), default=[20, 100, 500], help="Channel history depths")
+    parser.add_argument("--max-tokens", type=csv(int), default=[512, 4096], help="prompt_max_tokens values")
+    parser.add_argument("--models", type=csv(str), default=["gpt-3.5-turbo", "gpt-4"], help="Encoding models")
+    parser.add_argument("--lengths", type=csv(int), default=[50, 500], help="Message lengths in characters")
+    parser.add_argument("--reply-lengths", type=csv(int), default=[500, 4000, 20000],
+                        help="Reply lengths for the chunking helpers")
+    parser.add_argument("--repeat", type=int, default=50, help="Timed calls per case")
+    parser.add_argument("--tokenizer-processes", type=int, default=0,
+                        help="Also time cold builds with tokenization offloaded to this many worker processes")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
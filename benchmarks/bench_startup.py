@@ -0,0 +1,74 @@
+"""Startup benchmark: time from interpreter start until the bot is ready to connect to the gateway.
+
+Each run is a fresh interpreter that imports `main` and builds the bot with `create_bot`, which is everything
+`main()` does before `discord_client.run`. The "eager" mode then also does what startup used to do before
+connecting: import openai and tiktoken, create the OpenAI client and load the prompt model's encoding.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 20
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+from completions import LazyOpenAIClient, create_openai_client
+from settings import DEFAULT_SETTINGS, SettingsStore
+from tokenizer_registry import EncodingRegistry
+
+directory, eager = sys.argv[1], sys.argv[2] == "eager"
+settings = SettingsStore(directory + "/settings.json", dict(DEFAULT_SETTINGS, conversation_store=False,
+                                                            speech_cache_dir=directory + "/speech_cache"))
+encodings = EncodingRegistry()
+encoding_error = None
+if eager:
+    openai_client = create_openai_client("startup-benchmark", settings)
+    try:
+        encodings.get(settings["prompt_model"])
+    except Exception as e:
+        encoding_error = type(e).__name__
+else:
+    openai_client = LazyOpenAIClient("startup-benchmark", settings)
+main.create_bot(settings, openai_client, encodings)
+print(json.dumps({"ready": time.perf_counter() - start, "openai_loaded": "openai" in sys.modules,
+                  "tiktoken_loaded": "tiktoken" in sys.modules, "encoding_error": encoding_error}))
+"""
+
+
+def run_once(mode, directory):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", SCRIPT, directory, mode], check=True, capture_output=True,
+                            text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process"] = time.perf_counter() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters per mode")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="yagdb-startup-")
+    for mode in ("lazy", "eager"):
+        run_once(mode, directory)
+        results = [run_once(mode, directory) for _ in range(args.runs)]
+        ready = statistics.median(result["ready"] * 1000 for result in results)
+        process = statistics.median(result["process"] * 1000 for result in results)
+        last = results[-1]
+        note = f"  (encoding failed to load: {last['encoding_error']})" if last["encoding_error"] else ""
+        print(f"{mode:5}  ready to connect: {ready:7.1f}ms  whole process: {process:7.1f}ms  "
+              f"openai loaded: {last['openai_loaded']}, tiktoken loaded: {last['tiktoken_loaded']}{note}")
+
+
+if __name__ == "__main__":
+    main()
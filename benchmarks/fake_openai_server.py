@@ -0,0 +1,151 @@
+"""A local OpenAI-compatible chat completions server for load testing.
+
+Answers `POST /v1/chat/completions` (streaming or not) with random text after a configurable latency, and
+injects 429 responses with a Retry-After header at a configurable rate. When the request carries tools, it
+calls `do_auto_reply` with probability `reply_rate`. It can also run on its own:
+
+    python -m benchmarks.fake_openai_server --port 8000 --latency 0.5 --rate-limit-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+from benchmarks.fakes import random_text
+
+
+class FakeOpenAIServer:
+    def __init__(self, latency=0.3, jitter=0.2, rate_limit_rate=0.0, retry_after=1.0, reply_rate=0.5,
+                 reply_length=300, seed=0, model_latency=None):
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.reply_rate = reply_rate
+        self.reply_length = reply_length
+        self.counts = Counter()
+        self._rng = random.Random(seed)
+        self._runner = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving and return the base URL to point an OpenAI client at."""
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat_completions)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _chat_completions(self, request):
+        body = await request.json()
+        self.counts["requests"] += 1
+
+        if self._rng.random() < self.rate_limit_rate:
+            self.counts["rate_limited"] += 1
+            error = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            return web.json_response(error, status=429, headers={"retry-after": str(self.retry_after)})
+
+        latency = self.model_latency.get(body["model"], self.latency)
+        await asyncio.sleep(latency + self._rng.uniform(0, self.jitter))
+        content = random_text(self._rng.randint(self.reply_length // 2, self.reply_length), self._rng)
+        tool_calls = None
+        if body.get("tools"):
+            content = None
+            if self._rng.random() < self.reply_rate:
+                self.counts["tool_calls"] += 1
+                arguments = json.dumps({"reply": random_text(self.reply_length, self._rng)})
+                tool_calls = [{"id": f"call_{uuid.uuid4().hex}", "type": "function",
+                               "function": {"name": "do_auto_reply", "arguments": arguments}}]
+
+        prompt_tokens = sum(len(message.get("content") or "") for message in body["messages"]) // 4
+        completion_tokens = len(content or "") // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            return await self._stream(request, body["model"], content or "", usage if include_usage else None)
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "tool_calls": tool_calls},
+                "finish_reason": "tool_calls" if tool_calls else "stop",
+            }],
+            "usage": usage,
+        })
+
+    async def _stream(self, request, model, content, usage=None):
+        """Stream the content in small chunks, followed by a usage-only chunk when `usage` is given."""
+        response = web.StreamResponse(headers={"content-type": "text/event-stream"})
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        try:
+            await response.prepare(request)
+            for index in range(0, len(content), 20):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": content[index:index + 20]},
+                                 "finish_reason": None}],
+                }
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                await asyncio.sleep(0.005)
+            if usage is not None:
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": model, "choices": [], "usage": usage}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client went away, such as a hedged request that lost and was cancelled.
+            self.counts["disconnected"] += 1
+        return response
+
+
+def model_latency(value):
+    model, _, seconds = value.partition("=")
+    return model, float(seconds)
+
+
+async def serve(args):
+    server = FakeOpenAIServer(args.latency, args.jitter, args.rate_limit_rate, args.retry_after, args.reply_rate,
+                              model_latency=dict(args.model_latency))
+    print(f"Serving on {await server.start(args.host, args.port)}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.3, help="Base response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Extra random latency in seconds")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After sent with 429 responses")
+    parser.add_argument("--reply-rate", type=float, default=0.5, help="Chance of calling do_auto_reply")
+    parser.add_argument("--model-latency", type=model_latency, action="append", default=[],
+                        help="Base latency for one model, as MODEL=SECONDS. Can be repeated")
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Offline stand-ins for the discord.py and OpenAI objects the bot works with.
+
+The fakes only carry the attributes the bot reads. `isinstance` checks against the real classes still pass,
+because each fake reports the class it stands in for through `__class__`.
+"""
+import asyncio
+import functools
+import itertools
+import random
+import re
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import discord
+import openai
+
+from message_processing import get_encoding_for_model
+from tokenizer_pool import load_encoding_by_name as load_tiktoken_encoding
+
+WORDS = ("the quick brown fox jumps over lazy dog while bot replies with some markdown code and a few "
+         "longer words like tokenization, concurrency, throughput").split()
+
+_ids = itertools.count(1_000_000)
+
+
+def next_id():
+    return next(_ids)
+
+
+def random_text(length, rng=random):
+    """Generate roughly `length` characters of word-like text."""
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:length]
+
+
+class FakeEncoding:
+    """Approximates a tiktoken encoding for when the real encoding files can't be downloaded."""
+
+    _pattern = re.compile(r"\w{1,4}|[^\w\s]|\s+")
+
+    def __init__(self, name):
+        self.name = f"fake-{name}"
+
+    def encode(self, text):
+        return self._pattern.findall(text)
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+
+@functools.lru_cache(maxsize=None)
+def load_encoding(model):
+    """Load the model's tiktoken encoding, falling back to an approximate one when it can't be downloaded."""
+    try:
+        return get_encoding_for_model(model)
+    except Exception as e:
+        print(f"Couldn't load the tiktoken encoding for {model} ({type(e).__name__}), using an approximation")
+        return FakeEncoding(model)
+
+
+def load_encoding_by_name(name):
+    """Load an encoding by name in a tokenizer worker, including the approximations `load_encoding` falls back to."""
+    if name.startswith("fake-"):
+        return FakeEncoding(name[len("fake-"):])
+    return load_tiktoken_encoding(name)
+
+
+class FakeUser:
+    __class__ = property(lambda self: discord.User)
+
+    def __init__(self, name, bot=False):
+        self.id = next_id()
+        self.name = name
+        self.discriminator = "0"
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    __class__ = property(lambda self: discord.Message)
+
+    def __init__(self, channel, author, content):
+        self.id = next_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.created_at = datetime.now(timezone.utc)
+        self.edited_at = None
+        self.mentions = []
+        self.reference = None
+
+    async def edit(self, content):
+        self.content = self.clean_content = content
+        self.edited_at = datetime.now(timezone.utc)
+        return self
+
+    async def delete(self):
+        if self in self.channel.messages:
+            self.channel.messages.remove(self)
+
+
+class FakeChannel:
+    """A text channel whose history is served from memory, with an optional per-request latency."""
+
+    def __init__(self, guild=None, latency=0.0, keep_sent=True):
+        self.id = next_id()
+        self.name = f"channel-{self.id}"
+        self.guild = guild or SimpleNamespace(id=next_id(), name="guild")
+        self.latency = latency
+        self.keep_sent = keep_sent
+        self.messages = []
+        self.history_calls = 0
+        self.sent = []
+        self.on_send = None
+
+    def add(self, author, content):
+        message = FakeMessage(self, author, content)
+        self.messages.append(message)
+        return message
+
+    async def history(self, limit=100, oldest_first=False):
+        self.history_calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        messages = self.messages[-limit:] if limit else self.messages
+        for message in (messages if oldest_first else reversed(messages)):
+            yield message
+
+    async def send(self, content=None, file=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message = FakeMessage(self, self.bot_user, content or "")
+        if self.keep_sent:
+            self.messages.append(message)
+            self.sent.append(message)
+        if self.on_send is not None:
+            self.on_send(message)
+        return message
+
+    async def delete_messages(self, messages):
+        for message in messages:
+            if message in self.messages:
+                self.messages.remove(message)
+
+    bot_user = FakeUser("bot", bot=True)
+
+
+class FakeResponse:
+    def __init__(self):
+        self.deferred = False
+
+    async def defer(self, ephemeral=False):
+        self.deferred = True
+
+    async def send_message(self, content, ephemeral=False):
+        pass
+
+
+class FakeFollowup:
+    async def send(self, content, ephemeral=False):
+        pass
+
+
+class FakeInteraction:
+    __class__ = property(lambda self: discord.Interaction)
+
+    def __init__(self, channel, user, content=""):
+        self.id = next_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.user = user
+        self.data = {"content": content}
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+def fake_channel_with_history(depth, message_length, users=4, seed=0, **kwargs):
+    """Build a channel pre-filled with `depth` messages from a few users and the bot."""
+    rng = random.Random(seed)
+    channel = FakeChannel(**kwargs)
+    authors = [FakeUser(f"user{index}") for index in range(users)] + [FakeChannel.bot_user]
+    for _ in range(depth):
+        channel.add(rng.choice(authors), random_text(message_length, rng))
+    return channel
+
+
+def fake_completion(content, tool_calls=None, prompt_tokens=0, completion_tokens=0):
+    message = SimpleNamespace(content=content, tool_calls=tool_calls, role="assistant")
+    usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                            total_tokens=prompt_tokens + completion_tokens)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=usage)
+
+
+class StubAsyncOpenAI:
+    """Stands in for `openai.AsyncOpenAI`, answering every chat completion with a canned reply."""
+
+    __class__ = property(lambda self: openai.AsyncOpenAI)
+
+    def __init__(self, reply="stub reply", latency=0.0):
+        self.reply = reply
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, stream=False, **kwargs):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if stream:
+            return self._stream()
+        return fake_completion(self.reply)
+
+    async def _stream(self):
+        for index in range(0, len(self.reply), 16):
+            delta = SimpleNamespace(content=self.reply[index:index + 16])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
@@ -0,0 +1,258 @@
+"""End-to-end load test: replay channel traffic through the bot against a fake gateway and a fake OpenAI server.
+
+The bot is built with `main.create_bot`, so messages go through the real `on_message` handler and `/reply`
+goes through the real slash command. Events are fed in by a fake gateway instead of a websocket. OpenAI calls
+go over HTTP to a local OpenAI-compatible stub with configurable latency and 429 injection. Reports p50/p95/p99
+trigger-to-reply latency, event-loop lag and throughput.
+
+Run from the repository root, either with synthetic traffic or with a recorded JSONL file:
+
+    python -m benchmarks.load_replay --channels 20 --rate 10 --duration 60
+    python -m benchmarks.load_replay --channels 20 --rate 10 --duration 60 --record traffic.jsonl
+    python -m benchmarks.load_replay --replay traffic.jsonl
+
+Each recorded line looks like `{"at": 1.25, "channel": 3, "author": "user2", "content": "hi", "mention": false,
+"command": null}`, where `command` is "reply" for a /reply invocation.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fake_openai_server import FakeOpenAIServer, model_latency
+from benchmarks.fakes import FakeChannel, FakeInteraction, FakeUser, load_encoding, random_text
+from completions import create_openai_client
+from main import create_bot
+from settings import DEFAULT_SETTINGS, SettingsStore
+from tokenizer_registry import EncodingRegistry
+
+
+class FakeGateway:
+    """Feeds events into a discord.Client as if they came from the gateway, and times the bot's replies.
+
+    A message the bot sends is echoed back through `on_message`, like Discord does. The reply latency of a
+    message is measured from the newest message in the channel that hadn't been answered yet.
+    """
+
+    def __init__(self, discord_client, tree):
+        self.client = discord_client
+        self.tree = tree
+        self.bot_user = FakeChannel.bot_user
+        self.channels = []
+        self.message_latencies = []
+        self.command_latencies = []
+        self.replies = 0
+        self._unanswered = {}
+
+    async def connect(self):
+        await self.client._async_setup_hook()
+        self.client._connection.user = self.bot_user
+
+    def create_channel(self):
+        channel = FakeChannel()
+        channel.on_send = self._on_send
+        self.channels.append(channel)
+        return channel
+
+    def message(self, channel, author, content, mention=False):
+        """Post a message in a channel and dispatch it to the bot."""
+        if mention:
+            content = f"{self.bot_user.mention} {content}"
+        message = channel.add(author, content)
+        if mention:
+            message.mentions = [self.bot_user]
+        self._unanswered[channel.id] = time.perf_counter()
+        self.client.dispatch("message", message)
+
+    async def command(self, name, channel, user, content=""):
+        """Invoke a slash command the way an interaction from the gateway would."""
+        interaction = FakeInteraction(channel, user, content)
+        start = time.perf_counter()
+        await self.tree.get_command(name).callback(interaction)
+        self.command_latencies.append(time.perf_counter() - start)
+
+    def _on_send(self, message):
+        self.replies += 1
+        sent_at = self._unanswered.pop(message.channel.id, None)
+        if sent_at is not None:
+            self.message_latencies.append(time.perf_counter() - sent_at)
+        self.client.dispatch("message", message)
+
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up from a short sleep."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+
+def synthetic_traffic(args):
+    """Generate Poisson-distributed traffic across the channels."""
+    rng = random.Random(args.seed)
+    events = []
+    at = 0.0
+    while True:
+        at += rng.expovariate(args.rate)
+        if at >= args.duration:
+            return events
+        content = random_text(rng.randint(20, args.message_length), rng)
+        if rng.random() < args.question_rate:
+            content += "?"
+        events.append({
+            "at": round(at, 4),
+            "channel": rng.randrange(args.channels),
+            "author": f"user{rng.randrange(args.users)}",
+            "content": content,
+            "mention": rng.random() < args.mention_rate,
+            "command": "reply" if rng.random() < args.command_rate else None,
+        })
+
+
+def percentiles(samples):
+    if not samples:
+        return "n/a"
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+    return (f"p50 {at(0.50):.1f}ms  p95 {at(0.95):.1f}ms  p99 {at(0.99):.1f}ms  "
+            f"max {samples[-1] * 1000:.1f}ms  (n={len(samples)})")
+
+
+async def run(args, events):
+    server = FakeOpenAIServer(args.latency, args.jitter, args.rate_limit_rate, args.retry_after, args.reply_rate,
+                              seed=args.seed, model_latency=dict(args.model_latency))
+    base_url = await server.start()
+    work_dir = Path(tempfile.mkdtemp(prefix="yagdb-load-"))
+
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    settings.update({
+        "auto_reply": True,
+        "auto_reply_debounce": args.debounce,
+        "auto_reply_cooldown": args.cooldown,
+        "auto_reply_single_call": args.single_call,
+        "stream_replies": args.stream,
+        "prompt_model": args.model,
+        "fallback_models": [{"model": model} for model in args.fallback_model],
+        "hedge_after": args.hedge_after,
+        "openai_base_url": base_url,
+        "speech_cache_dir": str(work_dir / "speech_cache"),
+        "conversation_store_path": str(work_dir / "conversations.sqlite3"),
+        "retrieval_index_dir": str(work_dir / "retrieval_index"),
+    })
+    channel_count = max([args.channels] + [event["channel"] + 1 for event in events])
+    settings = SettingsStore(str(work_dir / "settings.json"), settings)
+
+    openai_client = create_openai_client("load-test", settings)
+    discord_client, tree, close_stores = create_bot(settings, openai_client, EncodingRegistry(load_encoding))
+    gateway = FakeGateway(discord_client, tree)
+    await gateway.connect()
+    channels = [gateway.create_channel() for _ in range(channel_count)]
+    settings["whitelist_channels"] = [channel.id for channel in channels]
+    users = {}
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    commands = set()
+    start = time.perf_counter()
+    for event in events:
+        delay = event["at"] - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        channel = channels[event["channel"]]
+        author = users.get(event["author"]) or users.setdefault(event["author"], FakeUser(event["author"]))
+        if event.get("command"):
+            task = asyncio.create_task(gateway.command(event["command"], channel, author, event["content"]))
+            commands.add(task)
+            task.add_done_callback(commands.discard)
+        else:
+            gateway.message(channel, author, event["content"], event.get("mention", False))
+    sent_for = time.perf_counter() - start
+
+    await asyncio.sleep(args.drain)
+    await asyncio.gather(*commands, return_exceptions=True)
+    monitor.stop()
+    elapsed = time.perf_counter() - start
+    await close_stores()
+    await server.stop()
+
+    messages = sum(1 for event in events if not event.get("command"))
+    print(f"Channels: {channel_count}, messages: {messages}, commands: {len(events) - messages}, "
+          f"offered rate: {len(events) / max(sent_for, 1e-9):.1f}/s over {sent_for:.1f}s")
+    print(f"Replies sent: {gateway.replies} ({gateway.replies / elapsed:.2f}/s), "
+          f"OpenAI requests: {server.counts['requests']}, 429s: {server.counts['rate_limited']}")
+    print(f"Message trigger-to-reply: {percentiles(gateway.message_latencies)}")
+    print(f"/reply command latency:   {percentiles(gateway.command_latencies)}")
+    print(f"Event loop lag:           {percentiles(monitor.samples)}  "
+          f"mean {statistics.fmean(monitor.samples or [0]) * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    traffic = parser.add_argument_group("traffic")
+    traffic.add_argument("--replay", help="Replay a recorded JSONL traffic file instead of generating traffic")
+    traffic.add_argument("--record", help="Write the generated traffic to this JSONL file")
+    traffic.add_argument("--channels", type=int, default=10, help="Whitelisted channels")
+    traffic.add_argument("--users", type=int, default=20, help="Distinct message authors")
+    traffic.add_argument("--rate", type=float, default=5.0, help="Messages per second across all channels")
+    traffic.add_argument("--duration", type=float, default=30.0, help="Seconds of traffic to generate")
+    traffic.add_argument("--message-length", type=int, default=200, help="Maximum message length")
+    traffic.add_argument("--mention-rate", type=float, default=0.1, help="Fraction of messages mentioning the bot")
+    traffic.add_argument("--question-rate", type=float, default=0.3, help="Fraction of messages ending in '?'")
+    traffic.add_argument("--command-rate", type=float, default=0.02, help="Fraction of events that are /reply")
+    traffic.add_argument("--seed", type=int, default=0)
+    fake_openai = parser.add_argument_group("fake OpenAI server")
+    fake_openai.add_argument("--latency", type=float, default=0.3, help="Base completion latency in seconds")
+    fake_openai.add_argument("--jitter", type=float, default=0.2, help="Extra random latency in seconds")
+    fake_openai.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests given a 429")
+    fake_openai.add_argument("--retry-after", type=float, default=1.0, help="Retry-After sent with 429s")
+    fake_openai.add_argument("--reply-rate", type=float, default=0.5, help="Chance a decision calls do_auto_reply")
+    fake_openai.add_argument("--model-latency", type=model_latency, action="append", default=[],
+                             help="Base latency for one model, as MODEL=SECONDS. Can be repeated")
+    bot = parser.add_argument_group("bot")
+    bot.add_argument("--debounce", type=float, default=DEFAULT_SETTINGS["auto_reply_debounce"])
+    bot.add_argument("--cooldown", type=float, default=DEFAULT_SETTINGS["auto_reply_cooldown"])
+    bot.add_argument("--single-call", action="store_true", help="Enable auto_reply_single_call")
+    bot.add_argument("--stream", action="store_true", help="Enable stream_replies")
+    bot.add_argument("--model", default=DEFAULT_SETTINGS["prompt_model"], help="prompt_model")
+    bot.add_argument("--fallback-model", action="append", default=[], help="Add a model to fallback_models")
+    bot.add_argument("--hedge-after", type=float, default=0.0, help="hedge_after in seconds")
+    parser.add_argument("--drain", type=float, default=10.0, help="Seconds to wait for replies after the traffic")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    if args.replay:
+        with open(args.replay) as file:
+            events = [json.loads(line) for line in file if line.strip()]
+    else:
+        events = synthetic_traffic(args)
+        if args.record:
+            with open(args.record, "w") as file:
+                file.writelines(json.dumps(event) + "\n" for event in events)
+    asyncio.run(run(args, events))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import asyncio
+import functools
+import logging
+import threading
+from metrics import metrics
+from request_scheduler import INTERACTIVE, is_retryable
+
+
+def create_openai_client(api_key, settings):
+    """Create the OpenAI client. Uses AsyncOpenAI over a pooled HTTP client unless "async_openai" is disabled.
+
+    Retries are left to the request scheduler, which honors Retry-After for every queued request at once.
+    "openai_base_url" points the client at an OpenAI-compatible server instead of the OpenAI API.
+    """
+    import httpx
+    import openai
+    base_url = settings["openai_base_url"]
+    if not settings["async_openai"]:
+        return openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+    max_requests = settings["max_concurrent_requests"]
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=max_requests, max_keepalive_connections=max_requests)
+    )
+    return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+class LazyOpenAIClient:
+    """Stands in for the OpenAI client and creates it on first use, so openai isn't imported during startup.
+
+    Call `get` from a background thread to create it ahead of the first request.
+    """
+
+    def __init__(self, api_key, settings):
+        self._api_key = api_key
+        self._settings = settings
+        self._client = None
+        self._lock = threading.Lock()
+        self._copies = {}
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = create_openai_client(self._api_key, self._settings)
+        return self._client
+
+    def with_options(self, base_url=None, api_key=None):
+        """Get a copy of the client for another base URL or key, made once and sharing the connection pool."""
+        key = (base_url, api_key)
+        if key not in self._copies:
+            self._copies[key] = self.get().with_options(base_url=base_url, api_key=api_key or self._api_key)
+        return self._copies[key]
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def model_tiers(client, settings):
+    """The (client, model) pairs to try for a reply: "prompt_model", then each of "fallback_models" in order.
+
+    A fallback with a "base_url" is served by an OpenAI-compatible server there, with its "api_key" if it has one.
+    """
+    tiers = [(client, settings["prompt_model"])]
+    for fallback in settings["fallback_models"]:
+        tier_client = client
+        if fallback.get("base_url"):
+            tier_client = client.with_options(base_url=fallback["base_url"], api_key=fallback.get("api_key"))
+        tiers.append((tier_client, fallback["model"]))
+    return tiers
+
+
+async def hedged(attempts, hedge_after=0.0, deadline=0.0, discard=None):
+    """Race attempts in order, returning the index and result of the first to succeed.
+
+    Each attempt is a coroutine function. The next one is started once the previous attempts have run for
+    `hedge_after` seconds without a result, or as soon as one fails. The rest are cancelled once one succeeds.
+    Raises the last error if every attempt fails, or `asyncio.TimeoutError` after `deadline` seconds. 0 turns
+    either off. `discard` is called with the result of an attempt that succeeded too but lost.
+    """
+    tasks = []
+    error = None
+
+    def start():
+        tasks.append(asyncio.ensure_future(attempts[len(tasks)]()))
+        if len(tasks) > 1:
+            logging.info("Hedging with attempt %d of %d", len(tasks), len(attempts))
+
+    async def race():
+        nonlocal error
+        start()
+        while True:
+            pending = [task for task in tasks if not task.done()]
+            timeout = hedge_after if hedge_after and len(tasks) < len(attempts) else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for index, task in enumerate(tasks):
+                if task not in done:
+                    continue
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = index
+                elif discard is not None:
+                    discard(task.result())
+            if winner is not None:
+                return winner, tasks[winner].result()
+            if len(tasks) < len(attempts):
+                start()
+            elif len(done) == len(pending):
+                raise error
+
+    try:
+        return await asyncio.wait_for(race(), deadline or None)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def first_delta(deltas):
+    """Wait for a stream's first delta. Returns it with the rest of the stream, or None for an empty stream."""
+    try:
+        return await deltas.__anext__(), deltas
+    except StopAsyncIteration:
+        return None
+
+
+def is_async_client(client):
+    """Check if a client is an AsyncOpenAI client rather than a blocking one."""
+    import openai
+    if isinstance(client, LazyOpenAIClient):
+        client = client.get()
+    return isinstance(client, openai.AsyncOpenAI)
+
+
+async def create_chat_completion(client, scheduler=None, priority=INTERACTIVE, tokens=0, **kwargs):
+    """Create a chat completion through the scheduler. Blocking clients are run in the default executor."""
+    if scheduler is None:
+        return await _create_chat_completion(client, **kwargs)
+    return await scheduler.run(lambda: _create_chat_completion(client, **kwargs), priority, tokens)
+
+
+async def _create_chat_completion(client, **kwargs):
+    with metrics.span("openai_total", model=kwargs.get("model")):
+        if is_async_client(client):
+            return await client.chat.completions.create(**kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(client.chat.completions.create, **kwargs))
+
+
+async def create_embeddings(client, scheduler=None, priority=INTERACTIVE, tokens=0, **kwargs):
+    """Create embeddings through the scheduler. Blocking clients are run in the default executor."""
+    if scheduler is None:
+        return await _create_embeddings(client, **kwargs)
+    return await scheduler.run(lambda: _create_embeddings(client, **kwargs), priority, tokens)
+
+
+async def _create_embeddings(client, **kwargs):
+    with metrics.span("openai_embeddings", model=kwargs.get("model")):
+        if is_async_client(client):
+            return await client.embeddings.create(**kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(client.embeddings.create, **kwargs))
+
+
+async def stream_chat_completion(client, scheduler=None, priority=INTERACTIVE, tokens=0, on_usage=None,
+                                 **kwargs):
+    """Stream a chat completion as text deltas. Blocking clients can't stream, so they yield the whole reply once.
+
+    `on_usage` is called with the response's token usage once the stream ends. The scheduler slot is held until
+    the stream ends. Errors before the first delta are retried like any other request; once text has been yielded,
+    the request can't be retried.
+    """
+    if scheduler is None:
+        async for delta in _stream_chat_completion(client, on_usage, **kwargs):
+            yield delta
+        return
+
+    attempt = 0
+    while True:
+        async with scheduler.slot(priority, tokens):
+            deltas = _stream_chat_completion(client, on_usage, **kwargs)
+            try:
+                first = await deltas.__anext__()
+            except StopAsyncIteration:
+                return
+            except Exception as error:
+                if not is_retryable(error):
+                    raise
+                delay = scheduler.backoff(error, attempt)
+                if delay is None:
+                    raise
+            else:
+                yield first
+                async for delta in deltas:
+                    yield delta
+                return
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _stream_chat_completion(client, on_usage, **kwargs):
+    if not is_async_client(client):
+        response = await _create_chat_completion(client, **kwargs)
+        if on_usage is not None:
+            on_usage(response.usage)
+        yield response.choices[0].message.content or ""
+        return
+    model = kwargs.get("model")
+    with metrics.span("openai_total", model=model):
+        with metrics.span("openai_ttft", model=model):
+            stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True},
+                                                          **kwargs)
+            chunks = stream.__aiter__()
+            first = None
+            async for chunk in chunks:
+                first = _chunk_text(chunk, on_usage)
+                if first:
+                    break
+        if first:
+            yield first
+        async for chunk in chunks:
+            text = _chunk_text(chunk, on_usage)
+            if text:
+                yield text
+
+
+def _chunk_text(chunk, on_usage):
+    """Get a stream chunk's text, passing the usage on the final chunk to `on_usage`."""
+    if chunk.usage is not None and on_usage is not None:
+        on_usage(chunk.usage)
+    if chunk.choices and chunk.choices[0].delta.content:
+        return chunk.choices[0].delta.content
+    return None
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+
+class ChannelSummary:
+    """A rolling summary of the turns evicted from a channel's context windows, shared by all of them.
+
+    Evicted turns are queued in `pending` to be folded into `text`. A turn is queued once, by whichever window
+    evicts it first, so the windows of different prompt formats don't have the same messages summarized twice.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.tokens = 0
+        self.pending = []
+        self.summarizing = False
+        self._queued_through = 0
+
+    def queue(self, turn):
+        """Queue an evicted turn to be summarized, unless another window already queued it."""
+        if turn[0] > self._queued_through:
+            self.pending.append(turn)
+            self._queued_through = turn[0]
+
+
+class ContextWindow:
+    """A channel's recent conversation, kept as a deque of rendered turns with a running token total.
+
+    Turns are (message id, role, content, tokens), oldest first. New messages are appended and the oldest turns
+    evicted in O(1) once the window holds more than `max_tokens` or `max_turns`. Evicted turns are queued in
+    the channel's `summary`, so they aren't simply forgotten.
+    """
+
+    def __init__(self, max_tokens, max_turns, summary=None):
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = summary if summary is not None else ChannelSummary()
+        self._last_id = 0
+        self._summarized_through = 0
+
+    def new_messages(self, history):
+        """Pick the messages of a newest-first history that the window hasn't seen yet, oldest first."""
+        newest = max(self._last_id, self._summarized_through)
+        fresh = []
+        for msg in history:
+            if msg.id <= newest:
+                break
+            fresh.append(msg)
+        fresh.reverse()
+        return fresh
+
+    def extend(self, turns):
+        """Append rendered turns, evicting the oldest ones past the window's limits.
+
+        Turns the window already holds or has summarized are skipped, since two prompt builds for a channel can
+        render the same new messages while they wait on the tokenizer.
+        """
+        for message_id, role, content, tokens in turns:
+            if message_id <= max(self._last_id, self._summarized_through):
+                continue
+            self.turns.append((message_id, role, content, tokens))
+            self.tokens += tokens + 1
+            self._last_id = max(self._last_id, message_id)
+        while self.turns and (self.tokens > self.max_tokens or len(self.turns) > self.max_turns):
+            turn = self.turns.popleft()
+            self.tokens -= turn[3] + 1
+            self.summary.queue(turn)
+            self._summarized_through = max(self._summarized_through, turn[0])
+
+    def select(self, budget, exclude_id=None):
+        """Get the newest turns that fit in `budget` tokens, oldest first, and the tokens they use."""
+        selected = []
+        used = 0
+        for turn in reversed(self.turns):
+            if turn[0] == exclude_id:
+                continue
+            if used + turn[3] + 1 >= budget:
+                break
+            selected.append(turn)
+            used += turn[3] + 1
+        selected.reverse()
+        return selected, used
+
+    def reset(self):
+        """Drop the window's turns after an edit or delete, so they're rendered again from the channel history.
+
+        The summary is kept, and messages it already covers aren't added back.
+        """
+        self.turns.clear()
+        self.tokens = 0
+        self._last_id = 0
+
+
+class ContextWindows:
+    """Context windows for the most recently used channels, one per channel and prompt format ("variant").
+
+    The windows of a channel share one summary. `summarize(summary, turns)` is awaited in the background to fold
+    evicted turns into it once `summary_batch` of them have piled up. Without it, evicted turns are dropped.
+    """
+
+    def __init__(self, max_tokens, max_channels=256, summarize=None, summary_batch=10, max_pending=200):
+        self.max_tokens = max_tokens
+        self.max_channels = max_channels
+        self.summarize = summarize
+        self.summary_batch = summary_batch
+        self.max_pending = max_pending
+        self._windows = OrderedDict()
+        self._tasks = set()
+
+    def get(self, channel_id, variant, max_turns):
+        key = (channel_id, variant)
+        window = self._windows.get(key)
+        if window is None:
+            summary = next((other.summary for (other_channel, _), other in self._windows.items()
+                            if other_channel == channel_id), None)
+            window = ContextWindow(self.max_tokens, max_turns, summary)
+            self._windows[key] = window
+            while len(self._windows) > self.max_channels:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(key)
+        return window
+
+    def invalidate(self, channel_id):
+        """Re-render a channel's windows on their next use, after one of its messages was edited or deleted."""
+        for (window_channel, _), window in self._windows.items():
+            if window_channel == channel_id:
+                window.reset()
+
+    def refresh_summary(self, window):
+        """Start folding a window's evicted turns into its summary in the background, once enough have piled up."""
+        summary = window.summary
+        if self.summarize is None:
+            summary.pending.clear()
+            return
+        if summary.summarizing:
+            return
+        del summary.pending[:-self.max_pending]
+        if len(summary.pending) < self.summary_batch:
+            return
+        summary.summarizing = True
+        task = asyncio.create_task(self._refresh(summary))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, summary):
+        turns = summary.pending[:]
+        try:
+            summary.text, summary.tokens = await self.summarize(summary.text, turns)
+            del summary.pending[:len(turns)]
+        except Exception as e:
+            logging.warning("Couldn't refresh a context summary: %s", e)
+        finally:
+            summary.summarizing = False
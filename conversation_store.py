@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Bumped when the schema changes. The store only caches token counts, so older databases are simply rebuilt.
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    edited_at REAL,
+    PRIMARY KEY (channel_id, message_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS token_counts (
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    encoding TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    PRIMARY KEY (channel_id, message_id, encoding, variant)
+) WITHOUT ROWID;
+"""
+
+
+def stale_message_ids(stored, live):
+    """Get the ids of stored messages that were deleted or edited since, judged against a page of live history.
+
+    `stored` holds (message id, edit timestamp) rows. Stored messages older than the page can't be checked and
+    aren't reported.
+    """
+    current = {msg.id: msg for msg in live}
+    oldest = min(current, default=None)
+    stale = []
+    for message_id, edited_at in stored:
+        live_msg = current.get(message_id)
+        if live_msg is None:
+            if oldest is None or message_id >= oldest:
+                stale.append(message_id)
+        elif _timestamp(live_msg.edited_at) != edited_at:
+            stale.append(message_id)
+    return stale
+
+
+def _timestamp(moment):
+    return moment.timestamp() if moment is not None else None
+
+
+class ConversationStore:
+    """Token counts of processed channel messages in a local SQLite database, for warm restarts.
+
+    Messages are kept by id and edit time only, which is enough to tell whether a stored count still applies. No
+    message content is stored. The database runs in WAL mode on a single worker thread, so nothing blocks the
+    event loop. Writes are buffered by `record` and written in one transaction every `flush_interval` seconds.
+    """
+
+    def __init__(self, path, flush_interval=2.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-store")
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self._connection.executescript(f"DROP TABLE IF EXISTS messages; DROP TABLE IF EXISTS token_counts; "
+                                           f"PRAGMA user_version = {SCHEMA_VERSION};")
+        self._connection.executescript(SCHEMA)
+        self._messages = {}
+        self._tokens = {}
+        self._flush_task = None
+
+    def record(self, messages, turns, encoding, variant):
+        """Buffer the token counts of rendered history messages to be written on the next flush."""
+        for msg, (_, _, _, tokens) in zip(messages, turns):
+            self._messages[(msg.channel.id, msg.id)] = (msg.channel.id, msg.id, msg.created_at.timestamp(),
+                                                        _timestamp(msg.edited_at))
+            self._tokens[(msg.channel.id, msg.id, encoding, variant)] = tokens
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def forget(self, channel_id, message_id):
+        """Drop a message after it was edited or deleted. Edited messages are stored again once re-rendered."""
+        self._messages.pop((channel_id, message_id), None)
+        for key in [key for key in self._tokens if key[:2] == (channel_id, message_id)]:
+            del self._tokens[key]
+        return self._run(self._delete, channel_id, message_id)
+
+    async def recent(self, channel_id, limit):
+        """Load a channel's newest `limit` stored messages, oldest first, with their token counts.
+
+        Returns (message id, edit timestamp) rows and a {(message id, encoding, variant): tokens} dict.
+        """
+        return await self._run(self._recent, channel_id, limit)
+
+    async def flush(self):
+        messages, self._messages = list(self._messages.values()), {}
+        tokens, self._tokens = [key + (count,) for key, count in self._tokens.items()], {}
+        if messages or tokens:
+            await self._run(self._write, messages, tokens)
+
+    async def compact(self, retention_days, max_messages):
+        """Delete messages older than `retention_days` and all but the newest `max_messages` per channel."""
+        removed = await self._run(self._compact, time.time() - retention_days * 86400, max_messages)
+        logging.info("Compacted the conversation store, removed %d messages", removed)
+        return removed
+
+    async def close(self):
+        await self.flush()
+        await self._run(self._connection.close)
+        self._executor.shutdown()
+
+    def _run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except sqlite3.Error as e:
+            logging.error("Couldn't write to the conversation store: %s", e)
+
+    def _write(self, messages, tokens):
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                                         messages)
+            self._connection.executemany("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?, ?, ?)", tokens)
+
+    def _delete(self, channel_id, message_id):
+        with self._connection:
+            self._connection.execute("DELETE FROM messages WHERE channel_id = ? AND message_id = ?",
+                                     (channel_id, message_id))
+            self._connection.execute("DELETE FROM token_counts WHERE channel_id = ? AND message_id = ?",
+                                     (channel_id, message_id))
+
+    def _recent(self, channel_id, limit):
+        rows = self._connection.execute(
+            "SELECT message_id, edited_at FROM messages WHERE channel_id = ? ORDER BY message_id DESC LIMIT ?",
+            (channel_id, limit),
+        ).fetchall()
+        rows.reverse()
+        if not rows:
+            return rows, {}
+        counts = self._connection.execute(
+            "SELECT message_id, encoding, variant, tokens FROM token_counts WHERE channel_id = ? AND message_id >= ?",
+            (channel_id, rows[0][0]),
+        ).fetchall()
+        return rows, {(message_id, encoding, variant): tokens for message_id, encoding, variant, tokens in counts}
+
+    def _compact(self, cutoff, max_messages):
+        with self._connection:
+            removed = self._connection.execute("DELETE FROM messages WHERE created_at < ?", (cutoff,)).rowcount
+            removed += self._connection.execute(
+                "DELETE FROM messages WHERE (channel_id, message_id) IN (SELECT channel_id, message_id FROM "
+                "(SELECT channel_id, message_id, ROW_NUMBER() OVER (PARTITION BY channel_id ORDER BY message_id DESC) "
+                "AS position FROM messages) WHERE position > ?)",
+                (max_messages,),
+            ).rowcount
+            self._connection.execute(
+                "DELETE FROM token_counts WHERE NOT EXISTS (SELECT 1 FROM messages WHERE "
+                "messages.channel_id = token_counts.channel_id AND messages.message_id = token_counts.message_id)"
+            )
+        self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._connection.execute("PRAGMA optimize")
+        return removed
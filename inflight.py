@@ -0,0 +1,63 @@
+import asyncio
+import logging
+
+
+class InflightGenerations:
+    """Per-channel tracking of in-flight reply generations, so a newer generation supersedes an older one.
+
+    A generation can be cancelled until it calls `commit`, right before it starts posting its reply. After that
+    it is left to finish, so a reply is never cut off halfway through being sent.
+
+    Generations run with `direct=False`, such as replies the model decided to make, never supersede a direct one,
+    such as a reply to a mention. They are skipped instead.
+    """
+
+    def __init__(self):
+        self.superseded = 0
+        self._tasks = {}
+        self._committed = set()
+        self._direct = set()
+
+    def supersede(self, channel_id, direct=True):
+        """Cancel the channel's in-flight generation, unless it has already started posting.
+
+        Returns False if it was left running because it is direct and the newer one isn't.
+        """
+        task = self._tasks.get(channel_id)
+        if task is None or task.done() or task is asyncio.current_task():
+            return True
+        if task in self._direct and not direct:
+            return False
+        if task in self._committed:
+            return True
+        task.cancel()
+        self.superseded += 1
+        logging.info("Cancelled a superseded generation in channel %s", channel_id)
+        return True
+
+    async def run(self, channel_id, coro, direct=True):
+        """Run a generation as the channel's in-flight one, superseding any older one.
+
+        Returns None without running it when a direct generation is in flight and this one isn't direct.
+        """
+        if not self.supersede(channel_id, direct):
+            coro.close()
+            logging.info("Skipping a generation in channel %s, a direct reply is in flight", channel_id)
+            return None
+        task = asyncio.current_task()
+        self._tasks[channel_id] = task
+        if direct:
+            self._direct.add(task)
+        try:
+            return await coro
+        finally:
+            self._committed.discard(task)
+            self._direct.discard(task)
+            if self._tasks.get(channel_id) is task:
+                del self._tasks[channel_id]
+
+    def commit(self):
+        """Mark the current generation as posting its reply, so it can no longer be superseded."""
+        task = asyncio.current_task()
+        if task in self._tasks.values():
+            self._committed.add(task)
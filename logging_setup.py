@@ -1,6 +1,78 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import random
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line. A prompt passed with `extra={"prompt": ...}` is kept as a list."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ("prompt", "token_count"):
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without formatting them, so %-style arguments are only rendered by the background writer.
+
+    Arguments must not be mutated after they're logged.
+    """
+
+    def prepare(self, record):
+        return record
 
 
 def setup_logging(settings):
-    """Set up logging level from global settings JSON."""
-    logging.basicConfig(level=settings["logging_level"])
+    """Set up logging from global settings JSON.
+
+    Records are put on a queue and written by a background thread, so log I/O never blocks the event loop.
+    "log_format" picks plain text or JSON lines.
+    """
+    handler = logging.StreamHandler()
+    if settings["log_format"] == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(settings["logging_level"])
+    return listener
+
+
+class PromptText:
+    """Renders a prompt as "role: content" lines, only when the log record is written."""
+
+    def __init__(self, message_history):
+        self.message_history = message_history
+
+    def __str__(self):
+        return "\n".join(f"{msg['role']}: {msg['content']}" for msg in self.message_history)
+
+
+def log_prompt(message_history, token_count, settings):
+    """Log a prepared prompt for a sampled fraction of replies, when "log_prompts" is enabled."""
+    if not settings["log_prompts"] or random.random() >= settings["log_prompt_sample_rate"]:
+        return
+    message_history = list(message_history)
+    logging.info("Prompt with %d tokens:\n%s", token_count, PromptText(message_history),
+                 extra={"prompt": message_history, "token_count": token_count})
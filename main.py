@@ -1,28 +1,43 @@
+import io
+import json
+import multiprocessing
+import sys
+import threading
 import uuid
-import openai
 import discord
 import logging
 import asyncio
 from discord.ext import tasks
-from pathlib import Path
 from random import randint
 from typing import Literal
 from api_keys import load_api_keys
-from settings import save_settings, load_settings
+from settings import SettingsStore, load_settings
+from logging_setup import setup_logging, log_prompt
 from discord_intents import setup_intents
+from auto_reply_gate import AutoReplyGate
+from inflight import InflightGenerations
+from request_scheduler import RequestScheduler, INTERACTIVE, AUTO_REPLY
+from completions import LazyOpenAIClient
+from context_window import ContextWindows
+from conversation_store import ConversationStore, stale_message_ids
+from message_cache import MessageHistoryCache
+from metrics import metrics
+from reply_history import LastReplies, delete_messages
+from reply_streaming import stream_reply
+from speech import SpeechCache, VoiceSessions, speak_text
+from token_cache import TokenCountCache
+from tokenizer_pool import TokenizerPool
+from tokenizer_registry import EncodingRegistry, SUPPORTED_MODELS
 from message_processing import (
     prepare_message_history,
     generate_response,
     generate_auto_response,
-    get_encoding_for_model,
+    stream_response,
+    send_reply_chunks,
     auto_prepare_message_history,
+    summarize_history,
 )
 
-last_messages = []
-last_user_message = None
-voice_channel_id = None
-disconnect_timer = None
-
 auto_tools = [
     {
         "type": "function",
@@ -38,44 +53,235 @@ auto_tools = [
     }
 ]
 
+# Used when "auto_reply_single_call" is on: the decision call writes the reply itself, saving a second completion.
+single_call_auto_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "do_auto_reply",
+            "description": "Makes the bot send a reply in the channel.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "reply": {
+                        "type": "string",
+                        "description": "The full message the bot sends in the channel.",
+                    },
+                },
+                "required": ["reply"],
+            },
+        },
+    }
+]
+
 # Shitty fix for mac.
-if not discord.opus.is_loaded():
+if sys.platform == "darwin" and not discord.opus.is_loaded():
     discord.opus.load_opus('/opt/homebrew/lib/libopus.dylib')
 
 
-def setup_logging(settings):
-    """Set up logging level from global settings JSON."""
-    logging.basicConfig(level=settings["logging_level"])
+def main():
+    settings = SettingsStore("settings.json", load_settings("settings.json"))
+    if settings["auto_shard"] and settings["shard_processes"] > 1:
+        run_shard_processes(settings)
+    else:
+        run_bot(settings)
 
 
-def main():
+def run_bot(settings, shard_ids=None, metrics_port=None):
     api_keys = load_api_keys()
-    openai.api_key = api_keys["openai_api_key"]
-    discord_api_token = api_keys["discord_api_token"]
-    settings = load_settings("settings.json")
-    enc = get_encoding_for_model(settings["prompt_model"])
-
     setup_logging(settings)
 
+    # The OpenAI client and the encodings are created after connecting, see on_ready.
+    openai_client = LazyOpenAIClient(api_keys["openai_api_key"], settings)
+    discord_client, tree, close_stores = create_bot(settings, openai_client, EncodingRegistry(), shard_ids,
+                                                    metrics_port)
+
+    try:
+        discord_client.run(token=api_keys["discord_api_token"], log_handler=None)
+    finally:
+        # The client's event loop is closed by now, so the stores' buffered writes are flushed on a new one.
+        asyncio.run(close_stores())
+        settings.flush()
+
+
+def run_shard_process(shard_ids, metrics_port):
+    """Entry point of a process started by `run_shard_processes`."""
+    run_bot(SettingsStore("settings.json", load_settings("settings.json")), shard_ids, metrics_port)
+
+
+def run_shard_processes(settings):
+    """Split the shards into "shard_processes" contiguous ranges and run each range in its own process.
+
+    Every process has its own gateway connections, caches and scheduler, and serves metrics on "metrics_port" plus
+    its index. Settings changed through commands are merged into settings.json rather than overwriting it, and
+    the other processes pick them up the next time they save settings themselves, or after a restart.
+    """
+    setup_logging(settings)
+    if not settings["shard_count"]:
+        logging.critical('"shard_processes" needs "shard_count" to be set, so the shards can be split up front.')
+        sys.exit(1)
+    shard_ids = settings["shard_ids"] or list(range(settings["shard_count"]))
+    count = min(settings["shard_processes"], len(shard_ids))
+
+    # Spawned rather than forked, so no process inherits the parent's logging thread or event loop state.
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(count):
+        shard_range = shard_ids[index * len(shard_ids) // count:(index + 1) * len(shard_ids) // count]
+        metrics_port = settings["metrics_port"] + index if settings["metrics_port"] else 0
+        process = context.Process(target=run_shard_process, args=(shard_range, metrics_port),
+                                  name=f"shards-{shard_range[0]}-{shard_range[-1]}")
+        process.start()
+        logging.info("Started process %s for shards %s", process.pid, shard_range)
+        processes.append(process)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The shard processes get the interrupt too and shut down on their own.
+        for process in processes:
+            process.join()
+
+
+def create_client(settings, intents, shard_ids=None):
+    """Create a plain client, or with "auto_shard" on, an `AutoShardedClient` for the given or configured shards."""
+    if not settings["auto_shard"]:
+        return discord.Client(intents=intents)
+    shard_ids = shard_ids if shard_ids is not None else settings["shard_ids"]
+    return discord.AutoShardedClient(intents=intents, shard_count=settings["shard_count"], shard_ids=shard_ids)
+
+
+def create_bot(settings, openai_client, encodings, shard_ids=None, metrics_port=None):
+    """Create the Discord client with all event handlers and slash commands registered.
+
+    `shard_ids` and `metrics_port` override the settings for one process of a multi-process deployment. Also
+    returns a coroutine function that saves what the bot's stores still hold in memory, to await at shutdown.
+    """
     intents = setup_intents(settings)
 
-    openai_client = openai.OpenAI(api_key=openai.api_key)
-    discord_client = discord.Client(intents=intents)
+    scheduler = RequestScheduler(settings["max_concurrent_requests"], settings["requests_per_minute"],
+                                 settings["tokens_per_minute"], settings["max_queued_requests"],
+                                 settings["max_request_retries"])
+    discord_client = create_client(settings, intents, shard_ids)
+    if metrics_port is None:
+        metrics_port = settings["metrics_port"]
+    history_cache = MessageHistoryCache(settings["history_cache_messages"], settings["history_cache_channels"])
+    token_cache = TokenCountCache(settings["token_cache_size"])
+
+    async def current_encoding():
+        """Get the encoding of the configured model, which /set_model can change at any time."""
+        return await encodings.get_async(settings["prompt_model"])
+
+    async def summarize(summary, turns):
+        return await summarize_history(summary, turns, settings, await current_encoding(), openai_client, scheduler)
+
+    context_windows = ContextWindows(
+        settings["prompt_max_tokens"], settings["history_cache_channels"],
+        summarize=summarize if settings["context_summaries"] else None,
+        summary_batch=settings["context_summary_batch"],
+    )
+    store = None
+    if settings["conversation_store"]:
+        store = ConversationStore(settings["conversation_store_path"], settings["conversation_flush_interval"])
+    retrieval = None
+    if settings["retrieval"]:
+        # Imported here so NumPy is only loaded when retrieval is on.
+        from retrieval import RetrievalIndex, create_embedder
+        retrieval = RetrievalIndex(settings["retrieval_index_dir"], create_embedder(settings, openai_client, scheduler),
+                                   settings["retrieval_top_k"], settings["retrieval_min_score"],
+                                   batch_size=settings["embedding_batch_size"],
+                                   max_turns=settings["retrieval_max_turns"],
+                                   save_interval=settings["retrieval_save_interval"])
+    tokenizer = None
+    if settings["tokenizer_processes"]:
+        tokenizer = TokenizerPool(settings["tokenizer_processes"], settings["tokenizer_pool_min_chars"])
+    # The caches and indexes the history builders read from and feed, in their argument order.
+    prompt_sources = (history_cache, token_cache, context_windows, retrieval, store, tokenizer)
+    auto_reply_gate = AutoReplyGate(settings["auto_reply_cooldown"], settings["auto_reply_debounce"],
+                                    settings["auto_reply_require_trigger"])
+    inflight = InflightGenerations()
+    last_replies = LastReplies(settings["history_cache_channels"])
+    speech_cache = SpeechCache(settings["speech_cache_dir"], settings["speech_cache_max_bytes"])
+    voice_sessions = VoiceSessions()
+    # Strong references to fire-and-forget tasks, so they aren't garbage collected while they run.
+    background_tasks = set()
 
     tree = discord.app_commands.CommandTree(discord_client)
 
+    metrics.add_collector("yagdb_scheduler_events_total", lambda: scheduler.counts)
+    metrics.add_collector("yagdb_auto_reply_decisions_total", lambda: auto_reply_gate.counts)
+    metrics.add_collector("yagdb_token_cache_total", lambda: {"hits": token_cache.hits, "misses": token_cache.misses})
+    metrics.add_collector("yagdb_generations_superseded_total", lambda: {"superseded": inflight.superseded})
+    if tokenizer is not None:
+        metrics.add_collector("yagdb_tokenizer_pool_texts_total", lambda: {"offloaded": tokenizer.offloaded})
+    metrics.add_collector("yagdb_requests_in_flight", lambda: {"active": scheduler.active, "queued": scheduler.queued},
+                          "gauge")
+
     @tasks.loop(minutes=5)
     async def disconnect_voice_channel():
-        global voice_channel_id
-        if voice_channel_id:
-            voice_channel = discord_client.get_channel(voice_channel_id)
-            if voice_channel:
-                for vc in discord_client.voice_clients:
-                    if vc.guild.id == voice_channel.guild.id and vc.channel.id == voice_channel.id:
-                        await vc.disconnect()
-                        voice_channel_id = None
-                        print("Disconnected from the voice channel due to inactivity.")
-                        break
+        await voice_sessions.disconnect_idle(discord_client.voice_clients, settings["voice_idle_timeout"])
+
+    @tasks.loop(hours=6)
+    async def compact_conversation_store():
+        await store.compact(settings["conversation_retention_days"], settings["conversation_max_messages"])
+
+    async def warm_caches():
+        """Fill the history and token caches of whitelisted channels, reusing stored token counts.
+
+        Runs in the background, warming up to "conversation_warm_concurrency" channels at a time. One page of live
+        history is fetched per channel, and stored messages that were deleted or edited while the bot was offline
+        are dropped from the store instead of having their counts reused.
+        """
+        enc = await current_encoding()
+        semaphore = asyncio.Semaphore(settings["conversation_warm_concurrency"])
+
+        async def warm_channel(channel_id):
+            channel = discord_client.get_channel(channel_id)
+            if channel is None:
+                return
+            async with semaphore:
+                rows, counts = await store.recent(channel_id, limit)
+                if not rows:
+                    return
+                try:
+                    # Backfilled through the history cache, so messages that arrive meanwhile aren't missed.
+                    live = await history_cache.history(channel, limit)
+                except discord.HTTPException as e:
+                    logging.warning("Couldn't fetch the history of channel %s: %s", channel_id, e)
+                    return
+            stale = set(stale_message_ids(rows, live))
+            for message_id in stale:
+                await store.forget(channel_id, message_id)
+            by_id = {msg.id: msg for msg in live}
+            reused = 0
+            for (message_id, encoding, variant), tokens in counts.items():
+                if encoding == enc.name and message_id in by_id and message_id not in stale:
+                    token_cache.seed(by_id[message_id], encoding, variant, tokens)
+                    reused += 1
+            logging.info("Warmed channel %s with %d stored token counts, dropped %d stale messages", channel_id,
+                         reused, len(stale))
+
+        limit = settings["history_cache_messages"]
+        results = await asyncio.gather(*(warm_channel(channel_id) for channel_id in settings["whitelist_channels"]),
+                                       return_exceptions=True)
+        for error in results:
+            if isinstance(error, Exception):
+                logging.warning("Couldn't warm a channel's caches: %s", error)
+
+    def warm_up():
+        """Create the OpenAI client and load every supported model's encoding, the configured model's first.
+
+        The tokenizer workers are then started with the configured model's encoding loaded.
+        """
+        if isinstance(openai_client, LazyOpenAIClient):
+            openai_client.get()
+        encodings.warm([settings["prompt_model"], *SUPPORTED_MODELS])
+        if tokenizer is not None:
+            try:
+                tokenizer.warm(encodings.get(settings["prompt_model"]).name)
+            except Exception as e:
+                logging.warning("Couldn't start the tokenizer workers: %s", e)
 
     @discord_client.event
     async def on_connect():
@@ -84,18 +290,34 @@ def main():
     @discord_client.event
     async def on_ready():
         logging.info("Ready!")
-        logging.debug("Syncing commands...")
-        await tree.sync()
-        logging.info(f'We have logged in as {discord_client.user}')
+        # Commands are global, so with several shard processes only the one running shard 0 syncs them.
+        if 0 in (getattr(discord_client, "shard_ids", None) or [discord_client.shard_id or 0]):
+            logging.debug("Syncing commands...")
+            await tree.sync()
+        logging.info("We have logged in as %s", discord_client.user)
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
         if not disconnect_voice_channel.is_running():
             disconnect_voice_channel.start()
+        if store is not None and not compact_conversation_store.is_running():
+            compact_conversation_store.start()
+            task = asyncio.create_task(warm_caches())
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        if metrics_port and not metrics.serving:
+            await metrics.serve(settings["metrics_host"], metrics_port)
+
+    @discord_client.event
+    async def on_guild_remove(guild):
+        if settings["voice_channels"].pop(str(guild.id), None) is not None:
+            settings.save()
+        voice_sessions.forget(guild.id)
 
     @tree.command(
         name="ping",
         description="Test if the bot is alive :))"
     )
     async def ping(ctx: discord.Interaction):
-        logging.info(f"Pong! sent to: {ctx.user} in {ctx.guild}'s channel {ctx.channel}")
+        logging.info("Pong! sent to: %s in %s's channel %s", ctx.user, ctx.guild, ctx.channel)
         await ctx.response.send_message("Pong!", ephemeral=True)
 
     @tree.command(
@@ -116,34 +338,23 @@ def main():
         description="Change the system prompt",
     )
     async def set_system_prompt(ctx: discord.Interaction, new_prompt: str):
-        if ctx.user.id not in settings["bot_admins"]:
+        if not settings.is_admin(ctx.user.id):
             await ctx.response.send_message("You do not have permission to change the system prompt!", ephemeral=True)
             return
         settings["system_prompt"] = new_prompt
-        save_settings("settings.json", settings)
+        settings.save()
         await ctx.response.send_message(f"# System prompt changed!", ephemeral=True)
 
     @tree.command(
         name="set_model",
         description="Change the model",
     )
-    async def set_model(ctx: discord.Interaction, new_model: Literal[
-        "gpt-3.5-turbo",
-        "gpt-3.5-turbo-16k",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-3.5-turbo-1106",
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-0301",
-        "gpt-4",
-        "gpt-4-1106-preview",
-        "gpt-4-0613",
-        "gpt-4-0314"
-    ]):
-        if ctx.user.id not in settings["bot_admins"]:
+    async def set_model(ctx: discord.Interaction, new_model: Literal[SUPPORTED_MODELS]):
+        if not settings.is_admin(ctx.user.id):
             await ctx.response.send_message("You do not have permission to change the model!", ephemeral=True)
             return
         settings["prompt_model"] = new_model
-        save_settings("settings.json", settings)
+        settings.save()
         await ctx.response.send_message(f"Model changed to: `{new_model}`!", ephemeral=True)
 
     @tree.command(
@@ -151,83 +362,73 @@ def main():
         description="Set a voice channel for the bot to speak in",
     )
     async def set_voice_channel(ctx: discord.Interaction, channel: discord.VoiceChannel):
-        global voice_channel_id
-        if ctx.user.id not in settings["bot_admins"]:
+        if not settings.is_admin(ctx.user.id):
             await ctx.response.send_message("You do not have permission to set the voice channel!", ephemeral=True)
             return
-        voice_channel_id = channel.id
+        # Stored per guild, with string keys since the settings are saved as JSON.
+        settings["voice_channels"][str(channel.guild.id)] = channel.id
+        settings.save()
         await ctx.response.send_message(f"Voice channel set to: {channel.name}", ephemeral=True)
 
     @tree.command(
         name="speak",
-        description="Make the bot speak the last message in the voice channel",
+        description="Make the bot speak its last message in this channel in the voice channel",
     )
     async def speak(ctx: discord.Interaction):
-        global last_messages, voice_channel_id, disconnect_timer
-
+        voice_channel_id = settings["voice_channels"].get(str(ctx.guild_id))
         if voice_channel_id is None:
             await ctx.response.send_message("No voice channel has been set!", ephemeral=True)
             return
 
-        if not last_messages:
+        previous = last_replies.get(ctx.channel.id)
+        if previous is None:
             await ctx.response.send_message("No messages to speak!", ephemeral=True)
             return
 
         await ctx.response.defer(ephemeral=True)
 
-        last_message_content = last_messages[-1].content
-
-        response = openai_client.audio.speech.create(
-            model="tts-1-hd",
-            voice="onyx",
-            input=last_message_content
-        )
-
-        speech_file_path = Path(__file__).parent / "speech.mp3"
-        response.stream_to_file(speech_file_path)
+        last_message_content = previous.text
 
         voice_channel = discord_client.get_channel(voice_channel_id)
-        if voice_channel is not None:
-            vc = await voice_channel.connect()
-            vc.play(discord.FFmpegPCMAudio(executable="ffmpeg", source=str(speech_file_path)))
-            while vc.is_playing():
-                await asyncio.sleep(1)
-            await vc.disconnect()
-
-            await ctx.followup.send("Finished speaking the last message.")
-        else:
+        if voice_channel is None:
             await ctx.followup.send("Failed to connect to the voice channel.")
+            return
 
-        if disconnect_timer is not None and disconnect_timer.is_running():
-            disconnect_timer.restart()
-        else:
-            disconnect_timer = disconnect_voice_channel
-            disconnect_timer.start()
+        try:
+            async with voice_sessions.lock(voice_channel.guild.id):
+                vc = await voice_sessions.connect(voice_channel)
+                await speak_text(vc, last_message_content, openai_client, settings, speech_cache, scheduler)
+                voice_sessions.touch(voice_channel.guild.id)
+        except Exception as e:
+            logging.error("Got an error:\n%s\nPlease try again later!", e)
+            await ctx.followup.send("Oops! Something went wrong. Please try again later", ephemeral=True)
+            return
+
+        await ctx.followup.send("Finished speaking the last message.")
 
     @tree.command(
         name="setup",
         description="Initial setup for the bot in the current channel",
     )
     async def setup_command(ctx: discord.Interaction):
-        if ctx.user.id not in settings["bot_admins"]:
+        if not settings.is_admin(ctx.user.id):
             await ctx.response.send_message("You do not have permission to setup the bot in this channel!",
                                             ephemeral=True)
             return
-        if ctx.channel.id in settings["whitelist_channels"]:
+        if settings.is_whitelisted(ctx.channel.id):
             await ctx.response.send_message("This channel has already been set up!", ephemeral=True)
             return
 
         await ctx.response.defer(ephemeral=True)
 
-        settings["whitelist_channels"].append(ctx.channel.id)
-        save_settings("settings.json", settings)
+        settings.whitelist_channel(ctx.channel.id)
 
         message_history = [
             {"role": "system", "content": f'Your name is {discord_client.user.name}. '
                                           f'{settings["system_prompt"]} '
                                           f'{settings["welcome_prompt"]}'}
         ]
-        reply = await generate_response(message_history, ctx, settings, openai_client)
+        reply = await generate_response(message_history, ctx, settings, openai_client, scheduler=scheduler)
 
         if reply:
             await ctx.channel.send(reply)
@@ -244,40 +445,72 @@ def main():
         description="Make the bot automatically reply when appropriate"
     )
     async def auto_reply(ctx: discord.Interaction, toggle: bool):
-        if ctx.user.id not in settings["bot_admins"]:
+        if not settings.is_admin(ctx.user.id):
             await ctx.response.send_message("You do not have permission to use this tool!", ephemeral=True)
             return
 
         settings["auto_reply"] = toggle
-        save_settings("settings.json", settings)
+        settings.save()
         await ctx.response.send_message(f"Auto reply set to: `{toggle}`!", ephemeral=True)
 
+    @tree.command(
+        name="auto_reply_stats",
+        description="Show how auto-reply decisions have been made",
+    )
+    async def auto_reply_stats(ctx: discord.Interaction):
+        if not settings.is_admin(ctx.user.id):
+            await ctx.response.send_message("You do not have permission to use this tool!", ephemeral=True)
+            return
+
+        await ctx.response.send_message(f"```\n{auto_reply_gate.stats()}\n"
+                                        f"superseded: {inflight.superseded}\n"
+                                        f"scheduler: {scheduler.stats()}\n```", ephemeral=True)
+
+    @tree.command(
+        name="metrics",
+        description="Dump per-stage latency and token usage metrics",
+    )
+    async def metrics_command(ctx: discord.Interaction):
+        if not settings.is_admin(ctx.user.id):
+            await ctx.response.send_message("You do not have permission to use this tool!", ephemeral=True)
+            return
+
+        dump = io.BytesIO(metrics.render().encode())
+        await ctx.response.send_message(file=discord.File(dump, "metrics.txt"), ephemeral=True)
+
     @tree.command(
         name="regenerate",
         description="Delete the last reply made by the bot and generate a new one",
     )
     async def regenerate_command(ctx: discord.Interaction):
-        global last_messages
-        global last_user_message
-
         await ctx.response.defer(ephemeral=True)
 
-        for message in last_messages:
-            await message.delete()
+        previous = last_replies.get(ctx.channel.id)
+        if previous is None:
+            logging.error("No user message to regenerate.")
+            await ctx.followup.send("No user message to regenerate.", ephemeral=True)
+            return
 
-        if last_user_message is not None:
-            message_history, token_count = await prepare_message_history(last_user_message, settings, enc,
-                                                                         discord_client)
-            reply = await generate_response(message_history, last_user_message, settings, openai_client)
+        # The old reply is deleted while the new one is generated from the same prompt.
+        inflight.supersede(ctx.channel.id)
+        deletion = asyncio.create_task(delete_messages(ctx.channel, previous.messages))
+        try:
+            text, messages = await generate_and_send(ctx, previous.message_history, previous.trigger, INTERACTIVE,
+                                                     previous.token_count)
+        except Exception as e:
+            logging.error("Got an error:\n%s\nPlease try again later!", e)
+            await ctx.followup.send("Oops! Something went wrong. Please try again later", ephemeral=True)
+            return
+        finally:
+            await deletion
 
-            if reply:
-                last_messages = await send_reply_chunks(ctx, reply)
-                await ctx.followup.send("Regenerated response!", ephemeral=True)
-            else:
-                logging.info("Received empty reply from OpenAI! Skipping...")
+        if messages:
+            last_replies.record(ctx.channel.id, previous.trigger, previous.message_history, previous.token_count,
+                                messages, text)
+            await ctx.followup.send("Regenerated response!", ephemeral=True)
         else:
-            logging.error("No user message to regenerate.")
-            await ctx.followup.send("No user message to regenerate.", ephemeral=True)
+            logging.info("Received empty reply from OpenAI! Skipping...")
+            await ctx.followup.send("Received an empty reply, try again!", ephemeral=True)
 
     @tree.command(
         name="reply",
@@ -288,106 +521,185 @@ def main():
 
     @discord_client.event
     async def on_message(current_message):
-        global auto_tools
+        history_cache.add(current_message)
 
-        if current_message.author == discord_client.user:
+        if current_message.author.id == discord_client.user.id:
+            auto_reply_gate.note_bot_message(current_message.channel.id)
             return
-        if current_message.channel.id not in settings["whitelist_channels"]:
+        if not settings.is_whitelisted(current_message.channel.id):
             return
 
         if settings["auto_reply"]:
-            try:
-                logging.info("Determining if auto-reply is appropriate...")
-
-                message_history, token_count = await auto_prepare_message_history(current_message, settings, enc,
-                                                                                  discord_client)
+            channel_id = current_message.channel.id
+            decision = auto_reply_gate.classify(current_message, discord_client.user)
+            if decision == "direct":
+                # A pending decision is moot, and an older generation is replying to stale context now. A decision
+                # call that was already sent is left to finish, but its reply gives way to this one.
+                auto_reply_gate.cancel(channel_id)
+                logging.info("Bot was addressed directly, replying without a decision call")
+                try:
+                    await inflight.run(channel_id, do_auto_reply(current_message))
+                except Exception as e:
+                    logging.error("Got an error:\n%s\nPlease try again later!", e)
+            elif decision == "decide":
+                # Only replaces a pending decision. Generations are superseded once this one decides to reply.
+                auto_reply_gate.schedule(current_message, decide_auto_reply)
+
+    async def decide_auto_reply(current_message):
+        global auto_tools, single_call_auto_tools
+
+        try:
+            logging.info("Determining if auto-reply is appropriate...")
+
+            enc = await current_encoding()
+            message_history, token_count = await auto_prepare_message_history(current_message, settings, enc,
+                                                                              discord_client, *prompt_sources)
+
+            tools = single_call_auto_tools if settings["auto_reply_single_call"] else auto_tools
+            reply = await generate_auto_response(message_history, current_message, settings, openai_client,
+                                                 tools, scheduler, token_count)
+
+            logging.debug("Received reply from OpenAI: %s", reply.content)
+
+            tool_calls = reply.tool_calls
+
+            if tool_calls:
+                for tool_call in tool_calls:
+                    if tool_call.function.name == "do_auto_reply":
+                        logging.info("Calling 'do_auto_reply' function")
+                        auto_reply_gate.counts["model_replies"] += 1
+                        arguments = json.loads(tool_call.function.arguments or "{}")
+                        await inflight.run(current_message.channel.id,
+                                           do_auto_reply(current_message, message_history, token_count,
+                                                         arguments.get("reply")),
+                                           direct=False)
+            else:
+                logging.info("No tool calls found")
 
-                reply = await generate_auto_response(message_history, current_message, settings, openai_client,
-                                                     auto_tools)
+        except Exception as e:
+            logging.error("Got an error:\n%s\nPlease try again later!", e)
 
-                logging.info(f"Received reply from OpenAI: {reply.content}")
+    @discord_client.event
+    async def on_message_edit(before, after):
+        history_cache.update(after)
+        context_windows.invalidate(after.channel.id)
+        await forget(after.channel.id, after.id)
 
-                tool_calls = reply.tool_calls
+    @discord_client.event
+    async def on_raw_message_edit(payload):
+        # on_message_edit only fires for messages in discord.py's own cache, so backfilled messages are refreshed here.
+        if payload.cached_message is not None:
+            return
+        # Older messages may still be stored or indexed after they have left the history cache.
+        await forget(payload.channel_id, payload.message_id)
+        # The payload carries the edited message, so there's no need to fetch it.
+        history_cache.update(payload.message)
+        if history_cache.contains_message(payload.channel_id, payload.message_id):
+            context_windows.invalidate(payload.channel_id)
 
-                if tool_calls:
-                    for tool_call in tool_calls:
-                        if tool_call.function.name == "do_auto_reply":
-                            logging.info("Calling 'do_auto_reply' function")
-                            await do_auto_reply(current_message)
-                else:
-                    logging.info("No tool calls found")
+    @discord_client.event
+    async def on_raw_message_delete(payload):
+        history_cache.remove(payload.channel_id, payload.message_id)
+        context_windows.invalidate(payload.channel_id)
+        await forget(payload.channel_id, payload.message_id)
 
-            except Exception as e:
-                logging.error(f"Got an error:\n{e}\nPlease try again later!")
+    @discord_client.event
+    async def on_raw_bulk_message_delete(payload):
+        for message_id in payload.message_ids:
+            history_cache.remove(payload.channel_id, message_id)
+            await forget(payload.channel_id, message_id)
+        context_windows.invalidate(payload.channel_id)
+
+    async def forget(channel_id, message_id):
+        """Drop an edited or deleted message from the conversation store and the retrieval index."""
+        if store is not None:
+            await store.forget(channel_id, message_id)
+        if retrieval is not None:
+            await retrieval.forget(channel_id, message_id)
 
     async def do_reply(ctx):
-        global last_messages, last_user_message, story_tools
-
         await ctx.response.defer(ephemeral=True)
+        inflight.supersede(ctx.channel.id)
 
-        message_history, token_count = await prepare_message_history(ctx, settings, enc, discord_client)
+        enc = await current_encoding()
+        message_history, token_count = await prepare_message_history(ctx, settings, enc, discord_client,
+                                                                     *prompt_sources)
 
-        logging.info("Message history:")
-        for msg in message_history:
-            logging.info(f"{msg['role']}: {msg['content']}")
+        log_prompt(message_history, token_count, settings)
 
-        logging.info(f"Total token count: {token_count}")
-
-        reply = await generate_response(message_history, ctx, settings, openai_client, story_tools)
+        try:
+            text, messages = await generate_and_send(ctx, message_history, ctx, INTERACTIVE, token_count)
+        except Exception as e:
+            logging.error("Got an error:\n%s\nPlease try again later!", e)
+            await ctx.followup.send("Oops! Something went wrong. Please try again later", ephemeral=True)
+            return
 
-        if reply:
-            last_messages = await send_reply_chunks(ctx, reply)
+        if messages:
+            last_replies.record(ctx.channel.id, ctx, message_history, token_count, messages, text)
         else:
             logging.info("Received empty reply from OpenAI! Skipping...")
 
-        last_user_message = ctx
         await ctx.followup.send("Replied to the message!", ephemeral=True)
 
-    async def do_auto_reply(current_message):
-        global last_messages, last_user_message, story_tools
-
-        message_history, token_count = await auto_prepare_message_history(current_message, settings, enc,
-                                                                          discord_client)
+    async def do_auto_reply(current_message, message_history=None, token_count=0, reply=None):
+        """Auto-reply to a message. Reuses the decision call's history and its written reply when given."""
+        if message_history is None:
+            enc = await current_encoding()
+            message_history, token_count = await auto_prepare_message_history(current_message, settings, enc,
+                                                                              discord_client, *prompt_sources)
 
-        for msg in message_history:
-            logging.info(f"{msg['role']}: {msg['content']}")
+        log_prompt(message_history, token_count, settings)
 
-        reply = await generate_response(message_history, current_message, settings, openai_client, story_tools)
+        if reply and reply.strip():
+            inflight.commit()
+            text = reply.strip()
+            messages = await send_reply_chunks(current_message, text, settings["reply_attachment_threshold"])
+        else:
+            text, messages = await generate_and_send(current_message, message_history, current_message, AUTO_REPLY,
+                                                     token_count)
 
-        if reply:
-            last_messages = await auto_send_reply_chunks(current_message, reply)
+        if messages:
+            last_replies.record(current_message.channel.id, current_message, message_history, token_count, messages,
+                                text)
         else:
             logging.info("Received empty reply from OpenAI! Skipping...")
 
-        last_user_message = current_message
-
-    async def auto_send_reply_chunks(current_message, reply):
-        max_length = 2000
-        reply_chunks = [reply[i:i + max_length] for i in range(0, len(reply), max_length)]
-
-        last_messages = []
-        for chunk in reply_chunks:
-            if chunk.strip():
-                message = await current_message.channel.send(chunk)
-                last_messages.append(message)
-            else:
-                logging.info("Skipping empty or whitespace-only message chunk.")
-        return last_messages
-
-    async def send_reply_chunks(ctx, reply):
-        max_length = 2000
-        reply_chunks = [reply[i:i + max_length] for i in range(0, len(reply), max_length)]
-
-        last_messages = []
-        for chunk in reply_chunks:
-            if chunk.strip():
-                message = await ctx.channel.send(chunk)
-                last_messages.append(message)
-            else:
-                logging.info("Skipping empty or whitespace-only message chunk.")
-        return last_messages
-
-    discord_client.run(token=discord_api_token)
+    async def generate_and_send(destination, message_history, trigger, priority, token_count):
+        """Generate a reply and post it in the destination's channel, streaming it when "stream_replies" is on.
+
+        Returns the reply text and the messages it was posted in.
+        """
+        if settings["stream_replies"]:
+            deltas = stream_response(message_history, trigger, settings, openai_client, scheduler, priority,
+                                     token_count)
+            parts = []
+            messages = await stream_reply(destination.channel, committing(deltas, parts), settings)
+            return "".join(parts).strip(), messages
+
+        reply = await generate_response(message_history, trigger, settings, openai_client, scheduler=scheduler,
+                                        priority=priority, prompt_tokens=token_count)
+        if not reply:
+            return "", []
+        inflight.commit()
+        return reply, await send_reply_chunks(destination, reply, settings["reply_attachment_threshold"])
+
+    async def committing(deltas, parts):
+        """Pass streamed text through and collect it in `parts`.
+
+        The in-flight generation is committed once the first text arrives.
+        """
+        async for delta in deltas:
+            inflight.commit()
+            parts.append(delta)
+            yield delta
+
+    async def close_stores():
+        if store is not None:
+            await store.close()
+        if retrieval is not None:
+            await retrieval.close()
+
+    return discord_client, tree, close_stores
 
 
 if __name__ == "__main__":
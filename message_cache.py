@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from itertools import islice
+
+
+class MessageHistoryCache:
+    """Bounded per-channel ring buffers of recent messages, kept up to date from gateway events.
+
+    A channel is backfilled from the REST API once, on a cold miss. After that, reads are served from memory and
+    the buffer is maintained by `add`, `update` and `remove`. The least recently used channels are evicted when
+    more than `max_channels` are cached.
+    """
+
+    def __init__(self, max_messages=100, max_channels=256):
+        self.max_messages = max_messages
+        self.max_channels = max_channels
+        self._channels = OrderedDict()
+        self._backfills = {}
+        self._pending = {}
+
+    def __contains__(self, channel_id):
+        return channel_id in self._channels
+
+    def contains_message(self, channel_id, message_id):
+        """Check if a message is held in a channel's buffer."""
+        buffer = self._channels.get(channel_id)
+        return buffer is not None and any(msg.id == message_id for msg in buffer)
+
+    async def history(self, channel, limit):
+        """Get up to `limit` recent messages in a channel, newest first."""
+        buffer = self._channels.get(channel.id)
+        if buffer is None:
+            buffer = await self._backfill(channel)
+        else:
+            self._channels.move_to_end(channel.id)
+        return list(islice(reversed(buffer), limit))
+
+    def add(self, message):
+        """Append a new message to its channel's buffer. Channels that aren't cached yet are ignored."""
+        channel_id = message.channel.id
+        if channel_id in self._pending:
+            self._pending[channel_id].append(("add", message))
+            return
+        buffer = self._channels.get(channel_id)
+        if buffer is not None:
+            buffer.append(message)
+
+    def update(self, message):
+        """Replace a cached message with its edited version."""
+        channel_id = message.channel.id
+        if channel_id in self._pending:
+            self._pending[channel_id].append(("update", message))
+            return
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        for index, msg in enumerate(buffer):
+            if msg.id == message.id:
+                buffer[index] = message
+                break
+
+    def remove(self, channel_id, message_id):
+        """Drop a deleted message from its channel's buffer."""
+        if channel_id in self._pending:
+            self._pending[channel_id].append(("remove", message_id))
+            return
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        for msg in buffer:
+            if msg.id == message_id:
+                buffer.remove(msg)
+                break
+
+    def evict(self, channel_id):
+        """Forget a channel, so the next read backfills it again."""
+        self._channels.pop(channel_id, None)
+
+    async def _backfill(self, channel):
+        """Fill a channel's buffer from the REST API, sharing the request between concurrent cold misses."""
+        task = self._backfills.get(channel.id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(channel))
+            self._backfills[channel.id] = task
+            task.add_done_callback(lambda _: self._backfills.pop(channel.id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, channel):
+        logging.debug("History cache miss for channel %s, backfilling %d messages", channel.id, self.max_messages)
+        self._pending[channel.id] = []
+        try:
+            messages = [msg async for msg in channel.history(limit=self.max_messages, oldest_first=False)]
+        finally:
+            pending = self._pending.pop(channel.id)
+
+        buffer = deque(reversed(messages), maxlen=self.max_messages)
+        self._channels[channel.id] = buffer
+        self._channels.move_to_end(channel.id)
+
+        # Replay events that arrived while the history was being fetched.
+        for op, value in pending:
+            if op == "add":
+                if not any(msg.id == value.id for msg in buffer):
+                    buffer.append(value)
+            elif op == "update":
+                self.update(value)
+            else:
+                self.remove(channel.id, value)
+
+        self._evict()
+        return buffer
+
+    def _evict(self):
+        while len(self._channels) > self.max_channels:
+            evicted, _ = self._channels.popitem(last=False)
+            logging.debug("Evicted channel %s from the history cache", evicted)
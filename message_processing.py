@@ -1,8 +1,14 @@
 import asyncio
 import discord
-import tiktoken
+import functools
+import io
+import logging
 import uuid
 from typing import Tuple
+from completions import create_chat_completion, first_delta, hedged, model_tiers, stream_chat_completion
+from metrics import metrics
+from reply_chunking import split_reply
+from request_scheduler import INTERACTIVE, BACKGROUND
 
 
 def count_tokens(text, enc):
@@ -11,113 +17,295 @@ def count_tokens(text, enc):
 
 
 def get_encoding_for_model(model):
-    """Get the encoding for a given model."""
+    """Get the encoding for a given model. tiktoken is imported on first use, since it's slow to import."""
+    import tiktoken
     return tiktoken.encoding_for_model(model)
 
 
-async def prepare_message_history(interaction, settings, enc, client) -> Tuple:
-    """Prepare message history for the OpenAI API using the "chat" format (system, user, assistant)."""
-    user_message = {
-        "role": "user",
-        "content": f"{interaction.user.name}: {interaction.data.get('content', '')}"
-    }
+async def fetch_channel_history(channel, limit, history_cache=None):
+    """Fetch recent messages in a channel, newest first. Uses the history cache when one is given."""
+    with metrics.span("history_fetch", cached=history_cache is not None):
+        if history_cache is not None:
+            return await history_cache.history(channel, limit)
+        return [msg async for msg in channel.history(limit=limit, oldest_first=False)]
+
+
+async def count_history_tokens(messages, contents, enc, variant, token_cache=None, tokenizer=None):
+    """Count tokens for rendered history messages, through the token cache and the tokenizer pool when given."""
+    with metrics.span("tokenization", variant=variant, pooled=tokenizer is not None):
+        if token_cache is None and tokenizer is not None:
+            return await tokenizer.count(enc, contents)
+        if token_cache is None:
+            return [len(tokens) for tokens in enc.encode_batch(contents)]
+        counts = await token_cache.count(messages, contents, enc, variant, tokenizer)
+    logging.debug("Token cache: %d hits, %d misses, %d entries", token_cache.hits, token_cache.misses, len(token_cache))
+    return counts
 
-    message_history = [
-        {"role": "system", "content": f'{settings["system_prompt"]}'}
-    ]
-    token_count = count_tokens(user_message["content"], enc)
 
-    async for msg in interaction.channel.history(limit=100, oldest_first=False):
-        if msg.id == interaction.id:
-            continue
-        if msg.author == client.user:
-            role = "assistant"
-            content = f"{msg.clean_content}"
-        else:
-            role = "user"
-            content = f"{msg.author.name}: {msg.clean_content}"
-
-        tokens = count_tokens(content, enc)
-
-        if token_count + tokens + 1 < settings["prompt_max_tokens"]:
-            message_history.insert(1, {"role": role, "content": content})
-            token_count += tokens + 1
-        else:
+def render_history_message(msg, client, variant):
+    """Render a history message as a (role, content) pair in the given prompt format ("reply" or "auto")."""
+    if msg.author.id == client.user.id:
+        return "assistant", f"{msg.clean_content}"
+    if variant == "auto":
+        return "user", f"{msg.author.name}#{msg.author.discriminator}: {msg.clean_content}"
+    return "user", f"{msg.author.name}: {msg.clean_content}"
+
+
+async def render_history(messages, enc, client, variant, token_cache=None, tokenizer=None):
+    """Render history messages as (message id, role, content, tokens) turns."""
+    rendered = [render_history_message(msg, client, variant) for msg in messages]
+    contents = [content for _, content in rendered]
+    counts = await count_history_tokens(messages, contents, enc, variant, token_cache, tokenizer)
+    return [(msg.id, role, content, tokens) for msg, (role, content), tokens in zip(messages, rendered, counts)]
+
+
+def select_recent(turns, budget):
+    """Take newest-first turns while they fit in `budget` tokens. Returns them oldest first with their token total."""
+    selected = []
+    used = 0
+    for turn in turns:
+        if used + turn[3] + 1 >= budget:
             break
+        selected.append(turn)
+        used += turn[3] + 1
+    selected.reverse()
+    return selected, used
 
+
+async def build_message_history(channel, trigger_id, user_message, system_prompt, variant, limit, settings, enc,
+                                client, history_cache=None, token_cache=None, context_windows=None,
+                                retrieval=None, store=None, tokenizer=None) -> Tuple:
+    """Build a prompt from the system prompt, as much recent channel history as fits and the user message.
+
+    With context windows, the channel's rendered history is kept between calls and only new messages are rendered,
+    and a summary of the turns that no longer fit is included after the system prompt. With a retrieval index,
+    up to "retrieval_budget_fraction" of the budget goes to the older messages most relevant to the user message.
+    Newly rendered messages are saved to the conversation store when one is given, and counted by the tokenizer
+    pool when there is one.
+    """
+    message_history = [{"role": "system", "content": system_prompt}]
+    token_count = count_tokens(user_message["content"], enc)
+    budget = settings["prompt_max_tokens"] - token_count
+    reserved = int(budget * settings["retrieval_budget_fraction"]) if retrieval is not None else 0
+    history = await fetch_channel_history(channel, limit, history_cache)
+
+    if context_windows is not None:
+        window = context_windows.get(channel.id, variant, limit)
+        new_messages = window.new_messages(history)
+        new_turns = await render_history(new_messages, enc, client, variant, token_cache, tokenizer)
+        window.extend(new_turns)
+        context_windows.refresh_summary(window)
+        summary = window.summary
+        if summary.text and summary.tokens < budget:
+            message_history.append({"role": "system", "content": f"Summary of the earlier conversation:\n"
+                                                                 f"{summary.text}"})
+            token_count += summary.tokens
+            budget -= summary.tokens
+        turns, used = window.select(budget - reserved, exclude_id=trigger_id)
+    else:
+        new_messages = [msg for msg in history if msg.id != trigger_id]
+        new_turns = await render_history(new_messages, enc, client, variant, token_cache, tokenizer)
+        turns, used = select_recent(new_turns, budget - reserved)
+
+    if store is not None:
+        store.record(new_messages, new_turns, enc.name, variant)
+
+    if retrieval is not None:
+        retrieval.add(channel.id, new_turns)
+        older_than = turns[0][0] if turns else trigger_id
+        retrieved, retrieved_tokens = await retrieval.search(channel.id, user_message["content"], older_than,
+                                                             reserved)
+        if retrieved:
+            transcript = "\n".join(f"{role}: {content}" for _, role, content, _ in retrieved)
+            message_history.append({"role": "system", "content": f"Relevant earlier messages:\n{transcript}"})
+            token_count += retrieved_tokens
+        elif reserved and context_windows is not None:
+            turns, used = window.select(budget, exclude_id=trigger_id)
+        elif reserved:
+            turns, used = select_recent(new_turns, budget)
+
+    message_history.extend({"role": role, "content": content} for _, role, content, _ in turns)
     message_history.append(user_message)
-    return message_history, token_count
+    return message_history, token_count + used
+
+
+async def prepare_message_history(interaction, settings, enc, client, history_cache=None, token_cache=None,
+                                  context_windows=None, retrieval=None, store=None, tokenizer=None) -> Tuple:
+    """Prepare message history for the OpenAI API using the "chat" format (system, user, assistant)."""
+    user_message = {
+        "role": "user",
+        "content": f"{interaction.user.name}: {interaction.data.get('content', '')}"
+    }
+    return await build_message_history(interaction.channel, interaction.id, user_message,
+                                       f'{settings["system_prompt"]}', "reply", 100, settings, enc, client,
+                                       history_cache, token_cache, context_windows, retrieval, store, tokenizer)
 
 
-async def auto_prepare_message_history(current_message, settings, enc, client) -> Tuple:
+async def auto_prepare_message_history(current_message, settings, enc, client, history_cache=None,
+                                       token_cache=None, context_windows=None, retrieval=None,
+                                       store=None, tokenizer=None) -> Tuple:
     """Prepare message history for the OpenAI API for function calling context."""
     user_message = {
         "role": "user",
         "content": f"{current_message.author.name}: {current_message.clean_content}"
     }
+    return await build_message_history(current_message.channel, current_message.id, user_message,
+                                       f'{settings["system_prompt"]}{settings["auto_reply_prompt"]}', "auto", 20,
+                                       settings, enc, client, history_cache, token_cache, context_windows,
+                                       retrieval, store, tokenizer)
 
-    message_history = [
-        {"role": "system", "content": f'{settings["system_prompt"]}{settings["auto_reply_prompt"]}'}
-    ]
-    token_count = count_tokens(user_message["content"], enc)
 
-    async for msg in current_message.channel.history(limit=20, oldest_first=False):
-        if msg.id == current_message.id:
-            continue
-        if msg.author == client.user:
-            role = "assistant"
-            content = f"{msg.clean_content}"
-        else:
-            role = "user"
-            content = f"{msg.author.name}#{msg.author.discriminator}: {msg.clean_content}"
-
-        tokens = count_tokens(content, enc)
-
-        if token_count + tokens + 1 < settings["prompt_max_tokens"]:
-            message_history.insert(1, {"role": role, "content": content})
-            token_count += tokens + 1
-        else:
-            break
+async def summarize_history(summary, turns, settings, enc, client, scheduler=None):
+    """Fold evicted conversation turns into a running summary. Returns the new summary and its token count."""
+    transcript = "\n".join(f"{role}: {content}" for _, role, content, _ in turns)
+    previous = f"Current summary:\n{summary}\n\n" if summary else ""
+    response = await create_chat_completion(
+        client,
+        scheduler,
+        BACKGROUND,
+        sum(turn[3] for turn in turns) + settings["context_summary_max_tokens"],
+        model=settings["prompt_model"],
+        messages=[
+            {"role": "system", "content": settings["context_summary_prompt"]},
+            {"role": "user", "content": f"{previous}New messages:\n{transcript}"},
+        ],
+        temperature=0.3,
+        max_tokens=settings["context_summary_max_tokens"],
+    )
+    metrics.record_usage(response.usage, settings["prompt_model"], None)
+    summary = (response.choices[0].message.content or "").strip()
+    return summary, count_tokens(summary, enc)
 
-    message_history.append(user_message)
-    return message_history, token_count
 
+def completion_options(tools):
+    """Optional chat completion arguments. `tools` is left out entirely when there are none."""
+    return {"tools": tools} if tools else {}
 
-async def generate_response(message_history, interaction, settings, client, tools):
-    """Generate a response using the OpenAI API."""
-    loop = asyncio.get_running_loop()
+
+def get_user_name(interaction):
+    """Get the name of the user behind an interaction or message."""
     if isinstance(interaction, discord.Interaction):
-        user_name = interaction.user.name
+        return interaction.user.name
     elif isinstance(interaction, discord.Message):
-        user_name = interaction.author.name
-    else:
-        raise TypeError("interaction must be a discord.Interaction or discord.Message object")
-    response = await loop.run_in_executor(
-        None,
-        lambda: client.chat.completions.create(
-            model=settings["prompt_model"],
+        return interaction.author.name
+    raise TypeError("interaction must be a discord.Interaction or discord.Message object")
+
+
+def record_fallback(tiers, index):
+    """Count a reply that came from a fallback model rather than "prompt_model"."""
+    if index:
+        logging.info("Replied with fallback model %s", tiers[index][1])
+        metrics.inc("yagdb_fallback_replies_total", model=tiers[index][1])
+
+
+async def generate_response(message_history, interaction, settings, client, tools=None, scheduler=None,
+                            priority=INTERACTIVE, prompt_tokens=0):
+    """Generate a response using the OpenAI API.
+
+    With "fallback_models", the request is hedged after "hedge_after" seconds with the next model in the chain,
+    and the first response wins. Models served from another "base_url" bypass the scheduler, since its budgets
+    are the OpenAI account's.
+    """
+    user_name = get_user_name(interaction)
+    tiers = model_tiers(client, settings)
+
+    async def attempt(tier_client, model):
+        return await create_chat_completion(
+            tier_client,
+            scheduler if tier_client is client else None,
+            priority,
+            prompt_tokens + settings["prompt_max_tokens"],
+            model=model,
             messages=message_history,
             temperature=0.7,
             top_p=0.9,
             max_tokens=settings["prompt_max_tokens"],
             user=f"{user_name}.{uuid.uuid4()}",
-            tools=tools
-        ),
-    )
+            **completion_options(tools)
+        )
+
+    index, response = await hedged([functools.partial(attempt, *tier) for tier in tiers], settings["hedge_after"],
+                                   settings["request_deadline"])
+    record_fallback(tiers, index)
+    metrics.record_usage(response.usage, tiers[index][1], interaction.channel.id)
     return response.choices[0].message.content.strip()
 
 
-async def generate_auto_response(message_history, current_message, settings, client, tools):
+async def stream_response(message_history, interaction, settings, client, scheduler=None, priority=INTERACTIVE,
+                          prompt_tokens=0):
+    """Generate a response using the OpenAI API, yielding the text as it arrives.
+
+    Hedged like `generate_response`, on the time to the first text: the first stream to produce some wins.
+    """
+    user_name = get_user_name(interaction)
+    tiers = model_tiers(client, settings)
+
+    def attempt(tier_client, model):
+        return first_delta(stream_chat_completion(
+            tier_client,
+            scheduler if tier_client is client else None,
+            priority,
+            prompt_tokens + settings["prompt_max_tokens"],
+            model=model,
+            messages=message_history,
+            temperature=0.7,
+            top_p=0.9,
+            max_tokens=settings["prompt_max_tokens"],
+            user=f"{user_name}.{uuid.uuid4()}",
+            on_usage=lambda usage: metrics.record_usage(usage, model, interaction.channel.id),
+        ))
+
+    def close(lost):
+        if lost is not None:
+            asyncio.ensure_future(lost[1].aclose())
+
+    index, started = await hedged([functools.partial(attempt, *tier) for tier in tiers], settings["hedge_after"],
+                                  settings["request_deadline"], discard=close)
+    if started is None:
+        return
+    record_fallback(tiers, index)
+    first, deltas = started
+    yield first
+    async for delta in deltas:
+        yield delta
+
+
+async def generate_auto_response(message_history, current_message, settings, client, tools, scheduler=None,
+                                 prompt_tokens=0):
     """Generate a response using the OpenAI API to determine if we're sending a new bot message."""
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(None,
-                                          lambda: client.chat.completions.create(
-                                              model=settings["prompt_model"],
-                                              messages=message_history,
-                                              temperature=0.7,
-                                              top_p=0.9,
-                                              max_tokens=settings["prompt_max_tokens"],
-                                              user=f"{current_message}.{uuid.uuid4()}",
-                                              tools=tools)
-                                          )
+    response = await create_chat_completion(
+        client,
+        scheduler,
+        BACKGROUND,
+        prompt_tokens + settings["prompt_max_tokens"],
+        model=settings["prompt_model"],
+        messages=message_history,
+        temperature=0.7,
+        top_p=0.9,
+        max_tokens=settings["prompt_max_tokens"],
+        user=f"{current_message}.{uuid.uuid4()}",
+        **completion_options(tools)
+    )
+    metrics.record_usage(response.usage, settings["prompt_model"], current_message.channel.id)
     return response.choices[0].message
+
+
+async def send_reply_chunks(destination, reply, attachment_threshold=0):
+    """Send a reply to an interaction's or message's channel, returning the sent messages.
+
+    The reply is split on paragraph and code block boundaries into 2000-character messages. Replies longer than
+    `attachment_threshold` characters are sent as a single text file instead, unless the threshold is 0.
+    """
+    if attachment_threshold and len(reply) > attachment_threshold:
+        with metrics.span("discord_send"):
+            message = await destination.channel.send(file=discord.File(io.BytesIO(reply.encode()), "reply.md"))
+        return [message]
+
+    last_messages = []
+    for chunk in split_reply(reply):
+        with metrics.span("discord_send"):
+            message = await destination.channel.send(chunk)
+        last_messages.append(message)
+    if not last_messages:
+        logging.info("Skipping empty or whitespace-only reply.")
+    return last_messages
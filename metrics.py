@@ -0,0 +1,123 @@
+import bisect
+import contextlib
+import logging
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """In-process stage timings and counters, rendered in the Prometheus text format.
+
+    Stage latencies go into the `yagdb_stage_seconds` histogram labeled by stage. Token usage from OpenAI
+    responses goes into counters labeled by model and channel. Collectors added with `add_collector` are called
+    at render time to report counters kept elsewhere, such as cache hit rates.
+    """
+
+    def __init__(self):
+        self._histograms = defaultdict(Histogram)
+        self._counters = defaultdict(float)
+        self._collectors = {}
+        self._runner = None
+
+    @contextlib.contextmanager
+    def span(self, stage, **labels):
+        """Time the enclosed block as a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def observe(self, stage, seconds, **labels):
+        self._histograms[("yagdb_stage_seconds", _labels(stage=stage, **labels))].observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        self._counters[(name, _labels(**labels))] += value
+
+    def record_usage(self, usage, model, channel_id):
+        """Count the prompt and completion tokens from an OpenAI response's `usage`."""
+        if usage is None:
+            return
+        self.inc("yagdb_prompt_tokens_total", usage.prompt_tokens, model=model, channel=channel_id)
+        self.inc("yagdb_completion_tokens_total", usage.completion_tokens, model=model, channel=channel_id)
+
+    def add_collector(self, name, collect, kind="counter"):
+        """Report the numeric values of `collect()`, a dict, as `name{key="..."}` at render time.
+
+        Adding a collector under a name that's already taken replaces it.
+        """
+        self._collectors[name] = (collect, kind)
+
+    def render(self):
+        lines = []
+        for name in sorted({name for name, _ in self._histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), histogram in sorted(self._histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_format(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format(labels)} {histogram.total}")
+                lines.append(f"{name}_count{_format(labels)} {histogram.count}")
+
+        for name in sorted({name for name, _ in self._counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(self._counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format(labels)} {value:g}")
+
+        for name, (collect, kind) in sorted(self._collectors.items()):
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(collect().items()):
+                if isinstance(value, (int, float)):
+                    lines.append(f"{name}{_format((('key', key),))} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        """Serve the metrics at http://host:port/metrics."""
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+
+    @property
+    def serving(self):
+        return self._runner is not None
+
+
+def _labels(**labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _format(labels):
+    if not labels:
+        return ""
+    escaped = (f'{key}="{value}"'.replace("\\", "\\\\").replace("\n", "\\n") for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+metrics = Metrics()
@@ -0,0 +1,73 @@
+import re
+
+MAX_MESSAGE_LENGTH = 2000
+
+_FENCE = re.compile(r"^\s*(`{3,}|~{3,})")
+# Room kept in every chunk for re-opening and closing a code fence.
+_FENCE_RESERVE = 100
+
+
+def split_reply(text, max_length=MAX_MESSAGE_LENGTH, close_last=True):
+    """Split a markdown reply into chunks of at most `max_length` characters.
+
+    Chunks end at paragraph breaks where possible, otherwise at line breaks, and only mid-line for lines that are
+    too long on their own. A code block that spans chunks is closed at the end of one and re-opened, with its
+    language, at the start of the next. With `close_last` off, a code block still open at the end of the text is
+    left open, for text that is still being generated.
+    """
+    chunks = []
+    lines = []
+    length = 0
+    fence = None
+    # The closing marker of the open code block, such as "```" or "~~~".
+    marker = None
+    # Line counts after which the chunk can be cut at a paragraph break outside a code block.
+    breaks = []
+
+    def emit(chunk_lines, open_fence):
+        chunk = "".join(chunk_lines).strip("\n").rstrip()
+        if not chunk.strip() or chunk.strip() == open_fence:
+            return
+        chunks.append(f"{chunk}\n{marker}" if open_fence is not None else chunk)
+
+    for piece in _pieces(text, max_length - _FENCE_RESERVE):
+        # Room for the closing marker of the open code block, or of the one this piece opens.
+        opening = _FENCE.match(piece) if fence is None else None
+        closer = marker or (opening.group(1)[:_FENCE_RESERVE // 4] if opening else "")
+        while lines and length + len(piece) + len(closer) + 1 > max_length:
+            cut = next((index for index in reversed(breaks) if len(lines) // 2 <= index <= len(lines)), None)
+            if cut is not None:
+                emit(lines[:cut], None)
+                lines = lines[cut:]
+                breaks = [index - cut for index in breaks if index > cut]
+            else:
+                emit(lines, fence)
+                lines = [fence + "\n"] if fence is not None else []
+                breaks = []
+            length = sum(len(line) for line in lines)
+
+        lines.append(piece)
+        length += len(piece)
+        match = _FENCE.match(piece)
+        if match and fence is None:
+            fence = piece.strip()[:_FENCE_RESERVE // 2]
+            marker = match.group(1)[:_FENCE_RESERVE // 4]
+        elif match and piece.strip() == match.group(1) and match.group(1).startswith(marker):
+            fence = marker = None
+            breaks.append(len(lines))
+        elif fence is None and not piece.strip():
+            breaks.append(len(lines))
+
+    emit(lines, fence if close_last else None)
+    return chunks
+
+
+def _pieces(text, max_length):
+    """Yield the lines of a text with their line endings, splitting lines longer than `max_length`."""
+    for line in text.splitlines(keepends=True):
+        while len(line) > max_length:
+            cut = line.rfind(" ", 0, max_length)
+            cut = cut + 1 if cut > max_length // 2 else max_length
+            yield line[:cut]
+            line = line[cut:]
+        yield line
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+import discord
+
+
+class PreparedReply:
+    """A reply the bot posted, with the trigger and the prompt it was generated from.
+
+    `text` is the whole reply, which the messages don't carry when it was sent as an attachment.
+    """
+
+    def __init__(self, trigger, message_history, token_count, messages, text):
+        self.trigger = trigger
+        self.message_history = message_history
+        self.token_count = token_count
+        self.messages = messages
+        self.text = text
+
+
+class LastReplies:
+    """The last reply in each of the most recently active channels, so /regenerate can reuse its prompt."""
+
+    def __init__(self, max_channels=256):
+        self.max_channels = max_channels
+        self._replies = OrderedDict()
+
+    def get(self, channel_id):
+        return self._replies.get(channel_id)
+
+    def record(self, channel_id, trigger, message_history, token_count, messages, text):
+        self._replies[channel_id] = PreparedReply(trigger, message_history, token_count, messages, text)
+        self._replies.move_to_end(channel_id)
+        while len(self._replies) > self.max_channels:
+            self._replies.popitem(last=False)
+
+
+async def delete_messages(channel, messages):
+    """Delete messages with one bulk request, falling back to deleting them one by one, all at once."""
+    if not messages:
+        return
+    try:
+        await channel.delete_messages(messages)
+    except (discord.Forbidden, discord.HTTPException) as e:
+        logging.info("Bulk delete failed (%s), deleting %d messages individually", e, len(messages))
+        results = await asyncio.gather(*(message.delete() for message in messages), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, discord.NotFound):
+                logging.warning("Couldn't delete a message: %s", result)
@@ -0,0 +1,77 @@
+import logging
+import time
+
+from metrics import metrics
+from reply_chunking import MAX_MESSAGE_LENGTH, split_reply
+
+
+class StreamingReply:
+    """A reply that is posted while it is still being generated.
+
+    The first message is sent as soon as there is visible text. After that, the message is edited in place at most
+    once every `edit_interval` seconds, and text past Discord's 2000-character limit rolls over into a new message,
+    at a paragraph or code block boundary.
+    """
+
+    def __init__(self, channel, edit_interval=1.0):
+        self.channel = channel
+        self.edit_interval = edit_interval
+        self.messages = []
+        self._text = ""
+        self._shown = ""
+        self._current = None
+        self._last_edit = 0.0
+
+    async def feed(self, delta):
+        """Add newly generated text, sending or editing messages as needed."""
+        if not self.messages and not self._text:
+            delta = delta.lstrip()
+        self._text += delta
+
+        if len(self._text) > MAX_MESSAGE_LENGTH:
+            # Only whole lines are split, so a code fence that is still arriving isn't mistaken for text.
+            cut = self._text.rfind("\n") + 1
+            head, tail = self._text[:cut], self._text[cut:]
+            *full, last = split_reply(head, close_last=False) or [""]
+            if not full:
+                head, tail = self._text, ""
+                *full, last = split_reply(head, close_last=False)
+            self._text = last + head[len(head.rstrip()):] + tail
+            for chunk in full:
+                await self._show(chunk)
+                self._current = None
+                self._shown = ""
+
+        if self._current is None or time.monotonic() - self._last_edit >= self.edit_interval:
+            await self._show(self._text)
+
+    async def finish(self):
+        """Flush the remaining text and return every message the reply was posted in."""
+        self._text = self._text.rstrip()
+        await self._show(self._text)
+        return self.messages
+
+    async def _show(self, text):
+        if not text.strip():
+            if self._current is None:
+                logging.info("Skipping empty or whitespace-only message chunk.")
+            return
+        if self._current is None:
+            with metrics.span("discord_send"):
+                self._current = await self.channel.send(text)
+            self.messages.append(self._current)
+        elif text != self._shown:
+            # Message.edit returns the edited message and leaves the old object's content as it was.
+            with metrics.span("discord_edit"):
+                self._current = await self._current.edit(content=text)
+            self.messages[-1] = self._current
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+
+async def stream_reply(channel, deltas, settings):
+    """Post a streamed reply to a channel. Returns the list of messages it was posted in."""
+    reply = StreamingReply(channel, settings["stream_edit_interval"])
+    async for delta in deltas:
+        await reply.feed(delta)
+    return await reply.finish()
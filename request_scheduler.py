@@ -0,0 +1,211 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+from collections import Counter
+
+from metrics import metrics
+
+# Lower values are dispatched first.
+INTERACTIVE = 0
+AUTO_REPLY = 1
+BACKGROUND = 2
+
+
+def is_retryable(error):
+    """Check if an OpenAI error is worth retrying: rate limits, connection errors and server errors."""
+    import openai
+    return isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+
+class RequestDropped(Exception):
+    """Raised for a queued request that was shed to make room for higher-priority work."""
+
+
+class TokenBucket:
+    """Refills continuously up to a per-minute budget. A budget of 0 means unlimited."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` can be taken. Amounts larger than the whole budget only wait for a full bucket."""
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+    def take(self, amount):
+        if self.capacity:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+
+
+class RequestScheduler:
+    """Central, priority-aware gate for OpenAI requests.
+
+    Requests wait in a priority queue until a concurrency slot is free and both the requests-per-minute and
+    tokens-per-minute budgets can cover them. A 429 pauses dispatching for its Retry-After period before the
+    request is retried, so the client's own retries are turned off. When more than `max_queued` requests are
+    waiting, the lowest-priority ones are dropped first; interactive requests are never dropped.
+    """
+
+    def __init__(self, max_concurrent=8, requests_per_minute=0, tokens_per_minute=0, max_queued=32,
+                 max_retries=3):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.counts = Counter()
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._queue = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._paused_until = 0.0
+        self._changed = asyncio.Event()
+        self._dispatcher = None
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def queued(self):
+        return sum(1 for *_, future in self._queue if not future.done())
+
+    async def run(self, call, priority=INTERACTIVE, tokens=0):
+        """Await `call()` once scheduled, retrying it after rate limits and transient API errors."""
+        attempt = 0
+        while True:
+            async with self.slot(priority, tokens):
+                try:
+                    return await call()
+                except Exception as error:
+                    if not is_retryable(error):
+                        raise
+                    delay = self.backoff(error, attempt)
+                    if delay is None:
+                        raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=INTERACTIVE, tokens=0):
+        """Hold a concurrency slot for the duration of a request, waiting for it in priority order."""
+        await self._acquire(priority, tokens)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def backoff(self, error, attempt):
+        """Get the delay before retrying a failed request, or None if it shouldn't be retried.
+
+        A rate limit pauses every queued request for the Retry-After period instead of delaying just this one.
+        """
+        import openai
+        if isinstance(error, openai.RateLimitError):
+            self.counts["rate_limited"] += 1
+            if attempt >= self.max_retries or getattr(error, "code", None) == "insufficient_quota":
+                return None
+            pause = _retry_after(error)
+            if pause is None:
+                pause = min(2 ** attempt, 60)
+            logging.warning("Rate limited by OpenAI, pausing requests for %.1fs", pause)
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self._changed.set()
+            return 0.0
+        if attempt >= self.max_retries:
+            return None
+        self.counts["retried"] += 1
+        return min(2 ** attempt, 60)
+
+    async def _acquire(self, priority, tokens):
+        future = asyncio.get_running_loop().create_future()
+        queued_at = time.perf_counter()
+        heapq.heappush(self._queue, (priority, next(self._sequence), tokens, future))
+        self._shed()
+        self._changed.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been granted just before the waiter was cancelled.
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release()
+            raise
+        metrics.observe("queue_wait", time.perf_counter() - queued_at, priority=priority)
+
+    def _release(self):
+        self._active -= 1
+        self._changed.set()
+
+    def _shed(self):
+        live = [entry for entry in self._queue if not entry[3].done()]
+        droppable = sorted((entry for entry in live if entry[0] > INTERACTIVE),
+                           key=lambda entry: (-entry[0], entry[1]))
+        for entry in droppable[:max(0, len(live) - self.max_queued)]:
+            entry[3].set_exception(RequestDropped(f"Dropped a priority {entry[0]} request, the queue is full"))
+            self.counts["dropped"] += 1
+        self._queue = [entry for entry in self._queue if not entry[3].done()]
+        heapq.heapify(self._queue)
+
+    def _delay(self, tokens):
+        """Seconds until the next request can go out, or None if it has to wait for a free slot."""
+        if self._active >= self.max_concurrent:
+            return None
+        return max(self._paused_until - time.monotonic(), self._requests.wait_time(1),
+                   self._tokens.wait_time(tokens))
+
+    async def _dispatch(self):
+        while self._queue:
+            self._changed.clear()
+            priority, _, tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+
+            delay = self._delay(tokens)
+            if delay is None or delay > 0:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                continue
+
+            heapq.heappop(self._queue)
+            self._requests.take(1)
+            self._tokens.take(tokens)
+            self._active += 1
+            self.counts["dispatched"] += 1
+            future.set_result(None)
+
+    def stats(self):
+        """Format the scheduler counters for display."""
+        counts = ", ".join(f"{name}: {count}" for name, count in sorted(self.counts.items()))
+        return f"active: {self._active}, queued: {self.queued}" + (f", {counts}" if counts else "")
+
+
+def _retry_after(error):
+    """Read the Retry-After delay in seconds from a rate limit error's response headers."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
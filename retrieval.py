@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import os
+import re
+import tempfile
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from completions import create_embeddings
+from request_scheduler import BACKGROUND, INTERACTIVE
+
+
+class HashingEmbedder:
+    """Embeds text locally by hashing its words into a fixed number of buckets. Needs no network access."""
+
+    _words = re.compile(r"\w+")
+
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    async def embed(self, texts, priority=BACKGROUND):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in self._words.findall(text.lower()):
+                digest = zlib.crc32(word.encode())
+                vectors[row, digest % self.dimensions] += 1.0 if digest & 0x80000000 else -1.0
+        return _normalize(vectors)
+
+
+class OpenAIEmbedder:
+    """Embeds text with the OpenAI embeddings API, `batch_size` texts per request."""
+
+    def __init__(self, client, model, scheduler=None, batch_size=64):
+        self.client = client
+        self.model = model
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.name = model
+
+    async def embed(self, texts, priority=BACKGROUND):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            response = await create_embeddings(self.client, self.scheduler, priority,
+                                               sum(len(text) for text in batch) // 4,
+                                               model=self.model, input=batch)
+            vectors.extend(item.embedding for item in response.data)
+        return _normalize(np.array(vectors, dtype=np.float32).reshape(len(texts), -1))
+
+
+def create_embedder(settings, client, scheduler=None):
+    """Create the embedder picked by the "retrieval_embedder" setting ("openai" or "local")."""
+    if settings["retrieval_embedder"] == "openai":
+        return OpenAIEmbedder(client, settings["embedding_model"], scheduler, settings["embedding_batch_size"])
+    return HashingEmbedder()
+
+
+class ChannelIndex:
+    """Embedded turns of one channel: message ids, unit vectors, token counts, roles and contents."""
+
+    def __init__(self, embedder_name, dimensions=0):
+        self.embedder_name = embedder_name
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.tokens = np.zeros(0, dtype=np.int32)
+        self.roles = []
+        self.contents = []
+        self.known = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, turns, vectors):
+        self.ids = np.concatenate([self.ids, np.array([turn[0] for turn in turns], dtype=np.int64)])
+        self.vectors = vectors if not len(self.vectors) else np.concatenate([self.vectors, vectors])
+        self.tokens = np.concatenate([self.tokens, np.array([turn[3] for turn in turns], dtype=np.int32)])
+        self.roles.extend(turn[1] for turn in turns)
+        self.contents.extend(turn[2] for turn in turns)
+
+    def remove(self, message_id):
+        """Drop a turn, so it is no longer retrieved and is embedded again if it comes back edited."""
+        keep = self.ids != message_id
+        if keep.all():
+            return False
+        self._keep(keep)
+        return True
+
+    def trim(self, max_turns):
+        """Keep only the newest `max_turns` turns."""
+        if len(self.ids) <= max_turns:
+            return False
+        keep = np.zeros(len(self.ids), dtype=bool)
+        keep[np.argsort(self.ids)[-max_turns:]] = True
+        self._keep(keep)
+        return True
+
+    def _keep(self, mask):
+        positions = np.flatnonzero(mask)
+        self.ids = self.ids[mask]
+        self.vectors = self.vectors[mask]
+        self.tokens = self.tokens[mask]
+        self.roles = [self.roles[index] for index in positions]
+        self.contents = [self.contents[index] for index in positions]
+        self.known = set(self.ids.tolist())
+
+    def search(self, query, older_than, budget, top_k, min_score):
+        """Get the most similar turns older than a message id that fit in `budget` tokens, oldest first."""
+        if not len(self.ids):
+            return [], 0
+        scores = self.vectors @ query
+        scores[self.ids >= older_than] = -np.inf
+        top_k = min(top_k, len(scores))
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        picked = []
+        used = 0
+        for index in candidates:
+            if scores[index] < min_score:
+                break
+            if used + self.tokens[index] + 1 > budget:
+                continue
+            picked.append(index)
+            used += int(self.tokens[index]) + 1
+        picked.sort(key=lambda index: self.ids[index])
+        return [(int(self.ids[index]), self.roles[index], self.contents[index], int(self.tokens[index]))
+                for index in picked], used
+
+    def save(self, path):
+        """Write the index to an .npz file through a temporary file and a rename."""
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".index-", suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez(file, embedder=np.array(self.embedder_name), ids=self.ids, vectors=self.vectors,
+                         tokens=self.tokens, roles=np.array(self.roles, dtype=str),
+                         contents=np.array(self.contents, dtype=str))
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, embedder_name):
+        """Load an index saved by `save`. Indexes built by a different embedder are discarded."""
+        try:
+            with np.load(path) as data:
+                if str(data["embedder"]) != embedder_name:
+                    logging.info("Discarding %s, it was built with another embedder", path)
+                    return cls(embedder_name)
+                index = cls(embedder_name)
+                index.ids = data["ids"]
+                index.vectors = data["vectors"]
+                index.tokens = data["tokens"]
+                index.roles = data["roles"].tolist()
+                index.contents = data["contents"].tolist()
+        except FileNotFoundError:
+            return cls(embedder_name)
+        index.known = set(index.ids.tolist())
+        return index
+
+
+class RetrievalIndex:
+    """Per-channel vector indexes of past turns, persisted as .npz files.
+
+    Turns passed to `add` are embedded in batches in the background, and each channel keeps only its newest
+    `max_turns`. Changed indexes are saved at most once every `save_interval` seconds, and by `close`. `search`
+    embeds the query and returns the most relevant older turns within a token budget. Only the most recently used
+    channels are kept in memory.
+    """
+
+    def __init__(self, directory, embedder, top_k=5, min_score=0.3, max_channels=64, batch_size=64, max_turns=5000,
+                 save_interval=30.0):
+        self.directory = Path(directory)
+        self.embedder = embedder
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_channels = max_channels
+        self.batch_size = batch_size
+        self.max_turns = max_turns
+        self.save_interval = save_interval
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._indexes = OrderedDict()
+        self._loading = {}
+        self._pending = {}
+        self._flushing = {}
+        self._forgotten = {}
+        self._dirty = {}
+        self._saving = {}
+
+    def add(self, channel_id, turns):
+        """Queue rendered (message id, role, content, tokens) turns to be embedded and indexed."""
+        turns = [turn for turn in turns if turn[2].strip()]
+        if not turns:
+            return
+        self._pending.setdefault(channel_id, []).extend(turns)
+        if channel_id not in self._flushing:
+            task = asyncio.create_task(self._flush(channel_id))
+            self._flushing[channel_id] = task
+            task.add_done_callback(lambda _: self._flushing.pop(channel_id, None))
+
+    async def forget(self, channel_id, message_id):
+        """Drop a message after it was edited or deleted. Edited messages are indexed again once re-rendered."""
+        pending = self._pending.get(channel_id)
+        if pending:
+            self._pending[channel_id] = [turn for turn in pending if turn[0] != message_id]
+        if channel_id in self._flushing:
+            self._forgotten.setdefault(channel_id, set()).add(message_id)
+        if channel_id not in self._indexes and channel_id not in self._dirty and not self._path(channel_id).exists():
+            return
+        index = await self._index(channel_id)
+        if index.remove(message_id):
+            self._save_later(channel_id, index)
+
+    async def close(self):
+        """Save every index with unsaved changes."""
+        for task in list(self._saving.values()):
+            task.cancel()
+        loop = asyncio.get_running_loop()
+        while self._dirty:
+            channel_id, index = self._dirty.popitem()
+            await loop.run_in_executor(None, index.save, self._path(channel_id))
+
+    async def search(self, channel_id, query, older_than, budget):
+        """Get the turns most relevant to `query` that are older than a message id, oldest first, and their tokens."""
+        if budget <= 0:
+            return [], 0
+        index = await self._index(channel_id)
+        if not len(index):
+            return [], 0
+        vector = (await self.embedder.embed([query], INTERACTIVE))[0]
+        return index.search(vector, older_than, budget, self.top_k, self.min_score)
+
+    def _path(self, channel_id):
+        return self.directory / f"{channel_id}.npz"
+
+    async def _index(self, channel_id):
+        index = self._indexes.get(channel_id)
+        if index is not None:
+            self._indexes.move_to_end(channel_id)
+            return index
+
+        task = self._loading.get(channel_id)
+        if task is None:
+            loop = asyncio.get_running_loop()
+            task = loop.run_in_executor(None, ChannelIndex.load, self._path(channel_id), self.embedder.name)
+            self._loading[channel_id] = task
+        try:
+            index = await asyncio.shield(task)
+        finally:
+            self._loading.pop(channel_id, None)
+        if channel_id not in self._indexes:
+            # An index evicted before its changes were saved is newer than the file on disk.
+            self._indexes[channel_id] = self._dirty.get(channel_id, index)
+            self._evict()
+        return self._indexes[channel_id]
+
+    def _evict(self):
+        # Evicted indexes with unsaved changes stay referenced by `_dirty` until they are saved.
+        while len(self._indexes) > self.max_channels:
+            self._indexes.popitem(last=False)
+
+    async def _flush(self, channel_id):
+        try:
+            index = await self._index(channel_id)
+            changed = False
+            while self._pending.get(channel_id):
+                batch, self._pending[channel_id] = (self._pending[channel_id][:self.batch_size],
+                                                    self._pending[channel_id][self.batch_size:])
+                batch = list({turn[0]: turn for turn in batch if turn[0] not in index.known}.values())
+                if not batch:
+                    continue
+                vectors = await self.embedder.embed([turn[2] for turn in batch])
+                # Turns forgotten while they were being embedded are left out.
+                forgotten = self._forgotten.pop(channel_id, set())
+                keep = [position for position, turn in enumerate(batch) if turn[0] not in forgotten]
+                if not keep:
+                    continue
+                batch, vectors = [batch[position] for position in keep], vectors[keep]
+                index.append(batch, vectors)
+                index.known.update(turn[0] for turn in batch)
+                changed = True
+            self._pending.pop(channel_id, None)
+            if index.trim(self.max_turns) or changed:
+                self._save_later(channel_id, index)
+        except Exception as e:
+            self._pending.pop(channel_id, None)
+            logging.warning("Couldn't index messages for channel %s: %s", channel_id, e)
+        finally:
+            self._forgotten.pop(channel_id, None)
+
+    def _save_later(self, channel_id, index):
+        self._dirty[channel_id] = index
+        if channel_id not in self._saving:
+            task = asyncio.create_task(self._save(channel_id))
+            self._saving[channel_id] = task
+            task.add_done_callback(lambda _: self._saving.pop(channel_id, None))
+
+    async def _save(self, channel_id):
+        await asyncio.sleep(self.save_interval)
+        index = self._dirty.pop(channel_id, None)
+        if index is None:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, index.save, self._path(channel_id))
+        except OSError as e:
+            self._dirty.setdefault(channel_id, index)
+            logging.warning("Couldn't save the retrieval index of channel %s: %s", channel_id, e)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
@@ -1,42 +1,272 @@
+import asyncio
+import contextlib
+import copy
 import json
+import os
 import sys
 import logging
+import tempfile
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def save_settings(file_name, settings):
-    """Save settings to a JSON file."""
-    with open(file_name, "w") as file:
-        json.dump(settings, file, indent=4)
+DEFAULT_SETTINGS = {
+    "prompt_model": "gpt-3.5-turbo-16k",
+    "system_prompt": "{Put your system prompt here!}",
+    "welcome_prompt": "{Put your welcome prompt here!}",
+    "auto_reply_prompt": "{Put your auto-reply prompt here!}",
+    "auto_reply": False,
+    "prompt_max_tokens": 512,
+    "logging_level": "INFO",
+    "log_format": "text",
+    "log_prompts": False,
+    "log_prompt_sample_rate": 0.1,
+    "discord_intents": {
+        "guilds": True,
+        "members": True,
+        "emojis": True,
+        "messages": True,
+        "message_content": True,
+        "reactions": True
+    },
+    "bot_admins": [],
+    "whitelist_channels": [],
+    "history_cache_messages": 100,
+    "history_cache_channels": 256,
+    "token_cache_size": 10000,
+    "tokenizer_processes": 0,
+    "tokenizer_pool_min_chars": 20000,
+    "context_summaries": False,
+    "context_summary_batch": 10,
+    "context_summary_max_tokens": 256,
+    "context_summary_prompt": "Summarize this Discord conversation for your own future reference. Keep who said "
+                              "what, open questions and anything the bot promised. Fold the new messages into the "
+                              "current summary and keep it under 150 words.",
+    "conversation_store": False,
+    "conversation_store_path": "conversations.sqlite3",
+    "conversation_flush_interval": 2.0,
+    "conversation_retention_days": 30,
+    "conversation_max_messages": 1000,
+    "conversation_warm_concurrency": 4,
+    "retrieval": False,
+    "retrieval_embedder": "local",
+    "embedding_model": "text-embedding-3-small",
+    "embedding_batch_size": 64,
+    "retrieval_index_dir": "retrieval_index",
+    "retrieval_top_k": 5,
+    "retrieval_min_score": 0.3,
+    "retrieval_budget_fraction": 0.25,
+    "retrieval_max_turns": 5000,
+    "retrieval_save_interval": 30.0,
+    "async_openai": True,
+    "openai_base_url": None,
+    "fallback_models": [],
+    "hedge_after": 0.0,
+    "request_deadline": 0.0,
+    "max_concurrent_requests": 8,
+    "requests_per_minute": 500,
+    "tokens_per_minute": 80000,
+    "max_queued_requests": 32,
+    "max_request_retries": 3,
+    "stream_replies": False,
+    "stream_edit_interval": 1.0,
+    "reply_attachment_threshold": 8000,
+    "auto_reply_cooldown": 30.0,
+    "auto_reply_debounce": 3.0,
+    "auto_reply_require_trigger": False,
+    "auto_reply_single_call": False,
+    "tts_model": "tts-1-hd",
+    "tts_voice": "onyx",
+    "speech_cache_dir": "speech_cache",
+    "speech_cache_max_bytes": 100000000,
+    "voice_idle_timeout": 300,
+    "voice_channels": {},
+    "auto_shard": False,
+    "shard_count": None,
+    "shard_ids": None,
+    "shard_processes": 1,
+    "metrics_host": "127.0.0.1",
+    "metrics_port": 0
+}
+
+
+def merge_settings(on_disk, base, current):
+    """Three-way merge: apply the changes made since `base` in `current` on top of the settings `on_disk`.
+
+    Several shard processes share one settings file, so each one only writes what it changed. Settings nobody
+    changed keep their value on disk. For lists and dicts, such as the whitelist and the voice channels, only the
+    items added or removed here are applied, so concurrent changes from other processes survive.
+    """
+    merged = dict(on_disk)
+    for key, value in current.items():
+        if key not in on_disk:
+            merged[key] = value
+        elif key not in base or value != base[key]:
+            merged[key] = _merge_value(on_disk[key], base.get(key), value)
+    return merged
+
+
+def _merge_value(on_disk, base, current):
+    if isinstance(on_disk, dict) and isinstance(base, dict) and isinstance(current, dict):
+        merged = {key: value for key, value in on_disk.items() if key in current or key not in base}
+        merged.update((key, value) for key, value in current.items() if key not in base or base[key] != value)
+        return merged
+    if isinstance(on_disk, list) and isinstance(base, list) and isinstance(current, list):
+        merged = [item for item in on_disk if item in current or item not in base]
+        return merged + [item for item in current if item not in base and item not in merged]
+    return current
+
+
+@contextlib.contextmanager
+def _file_lock(file_name):
+    """Hold an exclusive lock on a file's ".lock" companion, where the platform supports it."""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{file_name}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _merge_and_write(file_name, base, current):
+    """Merge `current` into the settings file under a lock and write it. Returns the merged settings."""
+    with _file_lock(file_name):
+        try:
+            with open(file_name, "r") as settings_file:
+                on_disk = json.load(settings_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            on_disk = {}
+        merged = merge_settings(on_disk, base, current)
+        _atomic_write(file_name, json.dumps(merged, indent=4))
+    return merged
+
+
+def _atomic_write(file_name, data):
+    """Write a file through a temporary file and a rename, so a crash mid-write can't leave it half written."""
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".settings-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, file_name)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class SettingsStore(dict):
+    """The settings dict, with set indexes for whitelisted channels and admins and write-behind saving.
+
+    `save` coalesces changes made within `save_delay` seconds into one write, which runs in the default executor
+    so the event loop never waits on disk. A failed write is retried after `retry_delay` seconds. Call `flush`
+    before exiting to write anything still pending.
+
+    Writes are merged into the file as it is on disk (see `merge_settings`), and changes other processes made
+    there are picked up with each write.
+    """
+
+    def __init__(self, file_name, settings, save_delay=1.0, retry_delay=10.0):
+        super().__init__(settings)
+        self.file_name = file_name
+        self.save_delay = save_delay
+        self.retry_delay = retry_delay
+        self._whitelist = set(self["whitelist_channels"])
+        self._admins = set(self["bot_admins"])
+        # The settings as last loaded or written, which changes are worked out against.
+        self._base = copy.deepcopy(settings)
+        self._dirty = False
+        self._timer = None
+        self._writer = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if key == "whitelist_channels":
+            self._whitelist = set(value)
+        elif key == "bot_admins":
+            self._admins = set(value)
+
+    def is_whitelisted(self, channel_id):
+        return channel_id in self._whitelist
+
+    def is_admin(self, user_id):
+        return user_id in self._admins
+
+    def whitelist_channel(self, channel_id):
+        """Add a channel to the whitelist and save."""
+        if channel_id not in self._whitelist:
+            self["whitelist_channels"].append(channel_id)
+            self._whitelist.add(channel_id)
+            self.save()
+
+    def save(self):
+        """Schedule a save. Without a running event loop, the settings are written immediately."""
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self._timer is None:
+            self._timer = loop.call_later(self.save_delay, self._start_writer, loop)
+
+    def flush(self):
+        """Write pending changes synchronously."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._dirty:
+            self._dirty = False
+            current = copy.deepcopy(dict(self))
+            self._written(current, _merge_and_write(self.file_name, self._base, current))
+
+    def _written(self, current, merged):
+        """Take up the changes other processes made, unless they were changed here again since `current`."""
+        self._base = merged
+        for key, value in merged.items():
+            if value != current.get(key) and self.get(key) == current.get(key):
+                self[key] = copy.deepcopy(value)
+
+    def _start_writer(self, loop):
+        self._timer = None
+        if self._writer is None or self._writer.done():
+            self._writer = loop.create_task(self._write_behind(loop))
+
+    async def _write_behind(self, loop):
+        while self._dirty:
+            self._dirty = False
+            # Snapshot on the loop so it is consistent, then leave the disk I/O to a thread.
+            current = copy.deepcopy(dict(self))
+            try:
+                merged = await loop.run_in_executor(None, _merge_and_write, self.file_name, self._base, current)
+            except OSError as e:
+                logging.error("Failed to save %s: %s", self.file_name, e)
+                self._dirty = True
+                if self._timer is None:
+                    self._timer = loop.call_later(self.retry_delay, self._start_writer, loop)
+                return
+            self._written(current, merged)
 
 
 def load_settings(file_name):
-    """Loads settings JSON, if it doesn't exist, create a template."""
+    """Loads settings JSON, if it doesn't exist, create a template. Missing keys are filled from the defaults."""
     try:
         with open(file_name, "r") as settings_file:
-            return json.load(settings_file)
+            settings = json.load(settings_file)
     except FileNotFoundError:
-        settings = {
-            "prompt_model": "gpt-3.5-turbo-16k",
-            "system_prompt": "{Put your system prompt here!}",
-            "welcome_prompt": "{Put your welcome prompt here!}",
-            "auto_reply_prompt": "{Put your auto-reply prompt here!}",
-            "auto_reply": False,
-            "prompt_max_tokens": 512,
-            "logging_level": "INFO",
-            "discord_intents": {
-                "guilds": True,
-                "members": True,
-                "emojis": True,
-                "messages": True,
-                "message_content": True,
-                "reactions": True
-            },
-            "bot_admins": [],
-            "whitelist_channels": []
-        }
         with open(file_name, "w") as settings_file:
-            json.dump(settings, settings_file, indent=4)
+            json.dump(DEFAULT_SETTINGS, settings_file, indent=4)
         logging.critical(
-            f"{file_name} not found! File \"{file_name}\" has been made as an example. Enter your settings and "
-            f"restart the bot.")
+            "%s not found! File \"%s\" has been made as an example. Enter your settings and restart the bot.",
+            file_name, file_name)
         sys.exit(1)
+
+    for key, value in DEFAULT_SETTINGS.items():
+        settings.setdefault(key, copy.deepcopy(value))
+    return settings
@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import discord
+
+from completions import is_async_client
+from metrics import metrics
+from request_scheduler import INTERACTIVE
+
+
+class SpeechCache:
+    """On-disk cache of synthesized speech, keyed by a hash of the model, voice and text.
+
+    Files are evicted oldest-used first once the cache grows past `max_bytes`. Every method does disk I/O, so call
+    them from an executor.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(model, voice, text):
+        return hashlib.sha256(f"{model}\0{voice}\0{text}".encode()).hexdigest()
+
+    def path(self, key):
+        return self.directory / f"{key}.mp3"
+
+    def get(self, key):
+        """Get the cached audio file for a key, marking it as recently used, or None on a miss."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def open(self):
+        """Open a temporary file to write new audio into, before it's committed with `commit`."""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        return os.fdopen(fd, "wb"), temp_path
+
+    def commit(self, key, temp_path):
+        os.replace(temp_path, self.path(key))
+        self.prune()
+
+    def prune(self):
+        files = sorted(self.directory.glob("*.mp3"), key=lambda path: path.stat().st_mtime)
+        total = sum(path.stat().st_size for path in files)
+        for path in files:
+            if total <= self.max_bytes:
+                break
+            total -= path.stat().st_size
+            path.unlink(missing_ok=True)
+
+
+class VoiceSessions:
+    """One persistent voice connection per guild.
+
+    Connections are reused between playbacks and only closed by `disconnect_idle` once they've been unused for
+    a while. Playback in a guild is serialized, since a voice client can only play one source at a time.
+    """
+
+    def __init__(self):
+        self._last_used = {}
+        self._locks = defaultdict(asyncio.Lock)
+
+    def lock(self, guild_id):
+        return self._locks[guild_id]
+
+    async def connect(self, channel):
+        """Get the guild's voice client, connecting or moving it to the channel if needed."""
+        voice_client = channel.guild.voice_client
+        if voice_client is not None and voice_client.is_connected():
+            if voice_client.channel.id != channel.id:
+                await voice_client.move_to(channel)
+        else:
+            voice_client = await channel.connect()
+        self.touch(channel.guild.id)
+        return voice_client
+
+    def touch(self, guild_id):
+        self._last_used[guild_id] = time.monotonic()
+
+    def forget(self, guild_id):
+        """Drop a guild's state after the bot left it."""
+        self._last_used.pop(guild_id, None)
+        lock = self._locks.get(guild_id)
+        if lock is not None and not lock.locked():
+            del self._locks[guild_id]
+
+    async def disconnect_idle(self, voice_clients, idle_timeout):
+        """Disconnect voice clients that haven't played anything in `idle_timeout` seconds."""
+        now = time.monotonic()
+        for voice_client in list(voice_clients):
+            guild_id = voice_client.guild.id
+            if voice_client.is_playing() or self.lock(guild_id).locked():
+                continue
+            if now - self._last_used.get(guild_id, 0.0) >= idle_timeout:
+                await voice_client.disconnect()
+                self._last_used.pop(guild_id, None)
+                logging.info("Disconnected from %s due to inactivity.", voice_client.channel)
+
+
+async def speak_text(voice_client, text, client, settings, speech_cache, scheduler=None):
+    """Speak text through a voice client.
+
+    Cached audio is played straight from disk. Otherwise the TTS response is streamed into FFmpeg through a pipe
+    as it arrives, and written to the cache alongside.
+    """
+    loop = asyncio.get_running_loop()
+    model, voice = settings["tts_model"], settings["tts_voice"]
+    key = speech_cache.key(model, voice, text)
+
+    cached = await loop.run_in_executor(None, speech_cache.get, key)
+    if cached is not None:
+        logging.debug("Speech cache hit for %s", key)
+        with metrics.span("tts_playback", cached=True):
+            await _play(voice_client, discord.FFmpegPCMAudio(str(cached)))
+        return
+
+    read_fd, write_fd = os.pipe()
+    reader, writer = os.fdopen(read_fd, "rb"), os.fdopen(write_fd, "wb")
+    try:
+        # Closing the read end once playback stops makes our writes fail fast if FFmpeg exits early.
+        finished = _play(voice_client, discord.FFmpegPCMAudio(reader, pipe=True), reader.close)
+        cache_file, temp_path = await loop.run_in_executor(None, speech_cache.open)
+    except BaseException:
+        # Such as FFmpeg missing. Closing the pipe also ends playback if it had started.
+        _close(reader, writer)
+        raise
+    playback_start = time.perf_counter()
+
+    # Audio is downloaded under the scheduler slot and fed to FFmpeg separately, which reads it at playback speed,
+    # so the slot and the HTTP response are released as soon as the whole file has arrived.
+    chunks = asyncio.Queue()
+    feeder = asyncio.create_task(_feed(chunks, writer, cache_file))
+    complete = False
+    metrics.inc("yagdb_tts_characters_total", len(text), model=model)
+    try:
+        with metrics.span("tts_synthesis", model=model):
+            if scheduler is None:
+                await _download(client, model, voice, text, chunks)
+            else:
+                async with scheduler.slot(INTERACTIVE):
+                    await _download(client, model, voice, text, chunks)
+        complete = True
+    finally:
+        chunks.put_nowait(None)
+        if not complete:
+            feeder.cancel()
+        fed = (await asyncio.gather(feeder, return_exceptions=True))[0]
+        if complete and fed is not None:
+            logging.error("Couldn't write the synthesized speech: %s", fed)
+            complete = False
+        await loop.run_in_executor(None, _close, writer, cache_file)
+        if complete:
+            await loop.run_in_executor(None, speech_cache.commit, key, temp_path)
+        else:
+            os.unlink(temp_path)
+            # The download's error is what gets raised, so how the cut-off playback ended is left unread.
+            finished.add_done_callback(lambda future: future.cancelled() or future.exception())
+    await finished
+    metrics.observe("tts_playback", time.perf_counter() - playback_start, cached=False)
+
+
+async def _download(client, model, voice, text, chunks):
+    async for chunk in _synthesize(client, model, voice, text):
+        chunks.put_nowait(chunk)
+
+
+async def _feed(chunks, writer, cache_file):
+    """Write queued audio to the cache file and FFmpeg's pipe until None is queued."""
+    loop = asyncio.get_running_loop()
+    piping = True
+    while (chunk := await chunks.get()) is not None:
+        await loop.run_in_executor(None, cache_file.write, chunk)
+        if not piping:
+            continue
+        try:
+            await loop.run_in_executor(None, _write_chunk, writer, chunk)
+        except BrokenPipeError:
+            logging.warning("Playback stopped before the speech finished streaming")
+            piping = False
+
+
+async def _synthesize(client, model, voice, text):
+    """Yield synthesized mp3 audio as it arrives. Blocking clients yield it all at once."""
+    if not is_async_client(client):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            None, lambda: client.audio.speech.create(model=model, voice=voice, input=text)
+        )
+        yield response.content
+        return
+    async with client.audio.speech.with_streaming_response.create(model=model, voice=voice, input=text) as response:
+        async for chunk in response.iter_bytes(16384):
+            yield chunk
+
+
+def _write_chunk(writer, chunk):
+    writer.write(chunk)
+    writer.flush()
+
+
+def _close(*files):
+    for file in files:
+        try:
+            file.close()
+        except BrokenPipeError:
+            pass
+
+
+def _play(voice_client, source, on_finish=None):
+    """Start playing a source and return a future that resolves once playback ends, or fails with its error."""
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    def resolve(error):
+        if finished.done():
+            return
+        if error is not None:
+            finished.set_exception(error)
+        else:
+            finished.set_result(None)
+
+    def after(error):
+        if on_finish is not None:
+            on_finish()
+        if error is not None:
+            logging.error("Voice playback failed: %s", error)
+        loop.call_soon_threadsafe(resolve, error)
+
+    voice_client.play(source, after=after)
+    return finished
@@ -0,0 +1,45 @@
+import asyncio
+
+from context_window import ContextWindows
+
+
+def turns(start, stop):
+    return [(message_id, "user", f"message {message_id}", 5) for message_id in range(start, stop)]
+
+
+def test_windows_of_a_channel_share_one_summary():
+    async def scenario():
+        calls = []
+
+        async def summarize(summary, batch):
+            calls.append([turn[0] for turn in batch])
+            return f"{summary} {len(batch)}".strip(), 1
+
+        windows = ContextWindows(10000, summarize=summarize, summary_batch=5)
+        reply, auto = windows.get(1, "reply", 10), windows.get(1, "auto", 5)
+        other = windows.get(2, "auto", 5)
+        for window in (reply, auto, other):
+            window.extend(turns(1, 16))
+            windows.refresh_summary(window)
+            await asyncio.sleep(0)
+        return calls, reply.summary is auto.summary, auto.summary is not other.summary
+
+    calls, shared, separate = asyncio.run(scenario())
+    # Channel 1's turns are summarized once, whichever of its windows evicted them first.
+    assert calls == [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10], list(range(1, 11))]
+    assert shared and separate
+
+
+def test_turns_are_queued_once_across_windows():
+    windows = ContextWindows(10000)
+    reply, auto = windows.get(1, "reply", 10), windows.get(1, "auto", 5)
+    auto.extend(turns(1, 16))
+    reply.extend(turns(1, 16))
+    assert [turn[0] for turn in auto.summary.pending] == list(range(1, 11))
+
+
+def test_extend_skips_turns_the_window_already_holds():
+    window = ContextWindows(10000).get(1, "reply", 100)
+    window.extend(turns(1, 9))
+    window.extend(turns(1, 9))
+    assert len(window.turns) == 8
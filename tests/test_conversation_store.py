@@ -0,0 +1,56 @@
+import asyncio
+import sqlite3
+
+from benchmarks.fakes import fake_channel_with_history
+from conversation_store import ConversationStore, stale_message_ids
+
+
+def test_round_trip_keeps_token_counts_but_no_content(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    channel = fake_channel_with_history(5, 50)
+
+    async def scenario():
+        store = ConversationStore(path, flush_interval=60.0)
+        store.record(channel.messages, [(msg.id, "user", msg.clean_content, 7) for msg in channel.messages],
+                     "cl100k_base", "reply")
+        await store.close()
+        store = ConversationStore(path)
+        try:
+            return await store.recent(channel.id, 100)
+        finally:
+            await store.close()
+
+    rows, counts = asyncio.run(scenario())
+    assert rows == [(msg.id, None) for msg in channel.messages]
+    assert counts == {(msg.id, "cl100k_base", "reply"): 7 for msg in channel.messages}
+    with sqlite3.connect(path) as connection:
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(messages)")]
+    assert columns == ["channel_id", "message_id", "created_at", "edited_at"]
+
+
+def test_rebuilds_databases_from_an_older_schema(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE messages (channel_id INTEGER, message_id INTEGER, clean_content TEXT)")
+        connection.execute("INSERT INTO messages VALUES (1, 2, 'hello')")
+
+    async def scenario():
+        store = ConversationStore(path)
+        try:
+            return await store.recent(1, 100)
+        finally:
+            await store.close()
+
+    assert asyncio.run(scenario()) == ([], {})
+
+
+def test_stale_messages_are_the_deleted_and_edited_ones_within_the_page():
+    channel = fake_channel_with_history(10, 50)
+    messages = list(channel.messages)
+    stored = [(msg.id, None) for msg in messages]
+    asyncio.run(messages[3].edit("changed"))
+    channel.messages.remove(messages[5])
+    # The oldest message is deleted too, but it is older than the live page, so it can't be judged.
+    channel.messages.remove(messages[0])
+    live = list(reversed(channel.messages))
+    assert stale_message_ids(stored, live) == [messages[3].id, messages[5].id]
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import pytest
+
+from completions import hedged
+
+
+async def answer(value, delay, error=None, started=None, cancelled=None):
+    if started is not None:
+        started.append(value)
+    try:
+        await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        if cancelled is not None:
+            cancelled.append(value)
+        raise
+    if error is not None:
+        raise error
+    return value
+
+
+def test_single_attempt_returns_its_result():
+    assert asyncio.run(hedged([lambda: answer("primary", 0.01)])) == (0, "primary")
+
+
+def test_hedges_after_delay_and_cancels_the_loser():
+    async def scenario():
+        cancelled = []
+        start = time.perf_counter()
+        result = await hedged([lambda: answer("slow", 1.0, cancelled=cancelled), lambda: answer("fast", 0.05)],
+                              hedge_after=0.1)
+        await asyncio.sleep(0)
+        return result, time.perf_counter() - start, cancelled
+
+    result, elapsed, cancelled = asyncio.run(scenario())
+    assert result == (1, "fast")
+    assert elapsed < 0.5
+    assert cancelled == ["slow"]
+
+
+def test_fallback_is_not_started_when_the_primary_answers_in_time():
+    async def scenario():
+        started = []
+        result = await hedged([lambda: answer("primary", 0.01, started=started),
+                               lambda: answer("fallback", 0.01, started=started)], hedge_after=0.5)
+        return result, started
+
+    assert asyncio.run(scenario()) == ((0, "primary"), ["primary"])
+
+
+def test_failure_starts_the_next_attempt_at_once():
+    async def scenario():
+        start = time.perf_counter()
+        result = await hedged([lambda: answer("primary", 0.01, ValueError("down")), lambda: answer("fallback", 0.01)])
+        return result, time.perf_counter() - start
+
+    result, elapsed = asyncio.run(scenario())
+    assert result == (1, "fallback")
+    assert elapsed < 0.5
+
+
+def test_raises_the_last_error_when_every_attempt_fails():
+    with pytest.raises(KeyError):
+        asyncio.run(hedged([lambda: answer("a", 0.01, ValueError("a")), lambda: answer("b", 0.01, KeyError("b"))]))
+
+
+def test_deadline_cancels_everything():
+    async def scenario():
+        cancelled = []
+        with pytest.raises(asyncio.TimeoutError):
+            await hedged([lambda: answer("a", 1.0, cancelled=cancelled), lambda: answer("b", 1.0, cancelled=cancelled)],
+                         hedge_after=0.02, deadline=0.1)
+        await asyncio.sleep(0)
+        return sorted(cancelled)
+
+    assert asyncio.run(scenario()) == ["a", "b"]
+
+
+def test_discards_results_that_also_succeeded_but_lost():
+    async def scenario():
+        discarded = []
+        gate = asyncio.Event()
+
+        async def wait_for_gate(value):
+            await gate.wait()
+            return value
+
+        race = asyncio.create_task(hedged([lambda: wait_for_gate("a"), lambda: wait_for_gate("b")],
+                                          hedge_after=0.01, discard=discarded.append))
+        await asyncio.sleep(0.05)
+        gate.set()
+        return await race, discarded
+
+    assert asyncio.run(scenario()) == ((0, "a"), ["b"])
@@ -0,0 +1,55 @@
+import asyncio
+
+from inflight import InflightGenerations
+
+
+async def generation(inflight, started, finished, name, commit=False):
+    started.append(name)
+    if commit:
+        inflight.commit()
+    await asyncio.sleep(0.05)
+    finished.append(name)
+    return name
+
+
+def run_both(first_direct, second_direct, commit=False):
+    async def scenario():
+        inflight = InflightGenerations()
+        started, finished = [], []
+        first = asyncio.create_task(inflight.run(1, generation(inflight, started, finished, "first", commit),
+                                                 direct=first_direct))
+        await asyncio.sleep(0.01)
+        second = await inflight.run(1, generation(inflight, started, finished, "second"), direct=second_direct)
+        await asyncio.gather(first, return_exceptions=True)
+        return started, finished, second, inflight.superseded
+
+    return asyncio.run(scenario())
+
+
+def test_newer_generation_supersedes_an_older_one():
+    assert run_both(False, False) == (["first", "second"], ["second"], "second", 1)
+    assert run_both(False, True) == (["first", "second"], ["second"], "second", 1)
+    assert run_both(True, True) == (["first", "second"], ["second"], "second", 1)
+
+
+def test_decided_generation_gives_way_to_a_direct_one():
+    assert run_both(True, False) == (["first"], ["first"], None, 0)
+
+
+def test_committed_generation_is_left_to_finish():
+    started, finished, second, superseded = run_both(False, False, commit=True)
+    assert sorted(finished) == ["first", "second"]
+    assert superseded == 0
+
+
+def test_other_channels_are_not_affected():
+    async def scenario():
+        inflight = InflightGenerations()
+        started, finished = [], []
+        first = asyncio.create_task(inflight.run(1, generation(inflight, started, finished, "first")))
+        await asyncio.sleep(0.01)
+        await inflight.run(2, generation(inflight, started, finished, "second"))
+        await first
+        return sorted(finished)
+
+    assert asyncio.run(scenario()) == ["first", "second"]
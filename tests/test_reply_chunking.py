@@ -0,0 +1,64 @@
+import random
+
+from reply_chunking import MAX_MESSAGE_LENGTH, split_reply
+
+
+def paragraphs(count, length):
+    return "\n\n".join(("word " * (length // 5)).strip() for _ in range(count))
+
+
+def test_short_reply_is_one_chunk():
+    assert split_reply("Hello there!") == ["Hello there!"]
+
+
+def test_packs_whole_paragraphs_into_each_chunk():
+    chunks = split_reply(paragraphs(20, 500))
+    # Three paragraphs of 499 characters and their breaks fit in 2000, a fourth doesn't.
+    assert len(chunks) == 7
+    assert all(len(chunk) == 1501 for chunk in chunks[:-1])
+
+
+def test_long_lines_are_split_at_spaces():
+    chunks = split_reply("word " * 1000)
+    assert all(len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks)
+    assert sum(chunk.count("word") for chunk in chunks) == 1000
+
+
+def test_code_block_is_closed_and_reopened_with_its_language():
+    text = "```python\n" + "\n".join(f"print({index})" for index in range(400)) + "\n```\nDone."
+    chunks = split_reply(text)
+    assert len(chunks) > 1
+    for chunk in chunks[:-1]:
+        assert chunk.startswith("```python\n")
+        assert chunk.endswith("\n```")
+    assert chunks[-1].endswith("```\nDone.")
+
+
+def test_tilde_fences_are_closed_with_tildes():
+    text = "~~~\n" + "\n".join(f"line {index}" for index in range(600)) + "\n~~~"
+    chunks = split_reply(text)
+    assert len(chunks) > 1
+    assert all(chunk.startswith("~~~\n") and chunk.endswith("\n~~~") for chunk in chunks)
+
+
+def test_open_code_block_is_left_open_without_close_last():
+    assert split_reply("```\nstill going", close_last=False) == ["```\nstill going"]
+    assert split_reply("```\nstill going") == ["```\nstill going\n```"]
+
+
+def test_random_markdown_stays_within_the_limit_and_keeps_its_text():
+    rng = random.Random(0)
+    for _ in range(300):
+        parts = []
+        for _ in range(rng.randint(1, 60)):
+            roll = rng.random()
+            if roll < 0.1:
+                parts.append(rng.choice(["```py", "~~~", "```", "````"]))
+            elif roll < 0.3:
+                parts.append("")
+            else:
+                parts.append("w" * rng.randint(1, 3000))
+        text = "\n".join(parts)
+        chunks = split_reply(text)
+        assert all(len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks)
+        assert sum(chunk.count("w") for chunk in chunks) == text.count("w")
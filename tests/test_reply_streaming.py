@@ -0,0 +1,59 @@
+import asyncio
+
+from reply_chunking import MAX_MESSAGE_LENGTH
+from reply_streaming import StreamingReply
+
+
+def paragraphs(count, length):
+    return "\n\n".join(("word " * (length // 5)).strip() for _ in range(count))
+
+
+class Message:
+    """Like discord.Message, editing returns a new object and leaves the old one unchanged."""
+
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content):
+        return Message(content)
+
+
+class Channel:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append(Message(content))
+        return self.sent[-1]
+
+
+def stream(text, edit_interval=0.0, step=37):
+    async def scenario():
+        reply = StreamingReply(Channel(), edit_interval)
+        for start in range(0, len(text), step):
+            await reply.feed(text[start:start + step])
+        return await reply.finish()
+
+    return asyncio.run(scenario())
+
+
+def test_streamed_reply_keeps_the_edited_messages():
+    messages = stream("Hello there, this is a streamed reply.", step=5)
+    assert [message.content for message in messages] == ["Hello there, this is a streamed reply."]
+
+
+def test_streamed_reply_rolls_over_within_the_limit():
+    text = paragraphs(12, 500)
+    messages = stream(text)
+    assert len(messages) > 1
+    assert all(len(message.content) <= MAX_MESSAGE_LENGTH for message in messages)
+    assert sum(message.content.count("word") for message in messages) == text.count("word")
+
+
+def test_streamed_code_block_is_reopened_across_messages():
+    text = "```js\n" + "\n".join(f"log({index});" for index in range(400)) + "\n```"
+    messages = stream(text)
+    assert len(messages) > 1
+    for message in messages:
+        assert message.content.startswith("```js\n")
+        assert message.content.endswith("\n```")
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from request_scheduler import AUTO_REPLY, BACKGROUND, INTERACTIVE, RequestDropped, RequestScheduler
+
+
+def rate_limit_error(retry_after):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(429, headers={"retry-after": str(retry_after)}, request=request)
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def test_dispatches_in_priority_order():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1)
+        order = []
+
+        async def request(name, priority):
+            async with scheduler.slot(priority):
+                order.append(name)
+
+        async with scheduler.slot():
+            tasks = [asyncio.create_task(request("background", BACKGROUND)),
+                     asyncio.create_task(request("auto", AUTO_REPLY)),
+                     asyncio.create_task(request("interactive", INTERACTIVE))]
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive", "auto", "background"]
+
+
+def test_sheds_lowest_priority_first_and_never_interactive():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, max_queued=1)
+
+        async def request(priority):
+            async with scheduler.slot(priority):
+                return priority
+
+        async with scheduler.slot():
+            background = asyncio.create_task(request(BACKGROUND))
+            await asyncio.sleep(0)
+            auto = asyncio.create_task(request(AUTO_REPLY))
+            await asyncio.sleep(0)
+            interactive = asyncio.create_task(request(INTERACTIVE))
+            await asyncio.sleep(0.01)
+        return await asyncio.gather(background, auto, interactive, return_exceptions=True), scheduler.counts
+
+    (background, auto, interactive), counts = asyncio.run(scenario())
+    assert isinstance(background, RequestDropped)
+    assert isinstance(auto, RequestDropped)
+    assert interactive == INTERACTIVE
+    assert counts["dropped"] == 2
+
+
+def test_rate_limit_pauses_for_retry_after_and_retries():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=2)
+        calls = []
+
+        async def call():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise rate_limit_error(0.2)
+            return "ok"
+
+        return await scheduler.run(call), calls, scheduler.counts
+
+    result, calls, counts = asyncio.run(scenario())
+    assert result == "ok"
+    assert calls[1] - calls[0] >= 0.19
+    assert counts["rate_limited"] == 1
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    async def scenario():
+        scheduler = RequestScheduler()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            raise ValueError("bad request")
+
+        with pytest.raises(ValueError):
+            await scheduler.run(call)
+        return calls, scheduler.active
+
+    assert asyncio.run(scenario()) == (1, 0)
+
+
+def test_cancelling_a_waiting_request_frees_its_place():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1)
+
+        async def request():
+            async with scheduler.slot():
+                return "done"
+
+        async with scheduler.slot():
+            waiting = asyncio.create_task(request())
+            await asyncio.sleep(0.01)
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+        result = await asyncio.wait_for(request(), 1)
+        return waiting.cancelled(), result, scheduler.active, scheduler.queued
+
+    assert asyncio.run(scenario()) == (True, "done", 0, 0)
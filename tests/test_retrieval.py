@@ -0,0 +1,61 @@
+import asyncio
+
+from retrieval import ChannelIndex, HashingEmbedder, RetrievalIndex
+
+
+def turn(message_id, content):
+    return message_id, "user", content, len(content.split())
+
+
+async def indexed(index, channel_id):
+    while channel_id in index._flushing:
+        await asyncio.sleep(0)
+    return await index._index(channel_id)
+
+
+def test_forget_drops_turns_and_lets_edits_be_indexed_again(tmp_path):
+    async def scenario():
+        index = RetrievalIndex(tmp_path, HashingEmbedder(), min_score=0.0, save_interval=0.0)
+        index.add(1, [turn(10, "pineapple pizza"), turn(11, "the weather is nice")])
+        await indexed(index, 1)
+        await index.forget(1, 10)
+        forgotten = (await index.search(1, "pineapple pizza", 100, 1000))[0]
+        index.add(1, [turn(10, "pineapple pizza, edited")])
+        channel = await indexed(index, 1)
+        return forgotten, channel.contents
+
+    forgotten, contents = asyncio.run(scenario())
+    assert [found[0] for found in forgotten] == [11]
+    assert sorted(contents) == ["pineapple pizza, edited", "the weather is nice"]
+
+
+def test_forgets_turns_that_are_still_waiting_to_be_embedded(tmp_path):
+    async def scenario():
+        index = RetrievalIndex(tmp_path, HashingEmbedder())
+        index.add(1, [turn(10, "pineapple pizza"), turn(11, "the weather is nice")])
+        await index.forget(1, 10)
+        return (await indexed(index, 1)).ids.tolist()
+
+    assert asyncio.run(scenario()) == [11]
+
+
+def test_keeps_only_the_newest_turns(tmp_path):
+    async def scenario():
+        index = RetrievalIndex(tmp_path, HashingEmbedder(), max_turns=3)
+        index.add(1, [turn(message_id, f"message {message_id}") for message_id in range(10, 20)])
+        return sorted((await indexed(index, 1)).ids.tolist())
+
+    assert asyncio.run(scenario()) == [17, 18, 19]
+
+
+def test_saves_are_deferred_until_the_interval_or_close(tmp_path):
+    async def scenario():
+        index = RetrievalIndex(tmp_path, HashingEmbedder(), save_interval=60.0)
+        index.add(1, [turn(10, "pineapple pizza")])
+        await indexed(index, 1)
+        saved_early = (tmp_path / "1.npz").exists()
+        await index.close()
+        return saved_early
+
+    assert asyncio.run(scenario()) is False
+    assert ChannelIndex.load(tmp_path / "1.npz", HashingEmbedder().name).ids.tolist() == [10]
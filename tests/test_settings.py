@@ -0,0 +1,123 @@
+import asyncio
+import json
+import threading
+
+import settings as settings_module
+from settings import DEFAULT_SETTINGS, SettingsStore, load_settings, merge_settings
+
+
+def settings_file(tmp_path, **overrides):
+    path = str(tmp_path / "settings.json")
+    with open(path, "w") as file:
+        json.dump({**DEFAULT_SETTINGS, **overrides}, file)
+    return path
+
+
+def read(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def test_concurrent_whitelist_adds_and_removes_are_both_kept():
+    base = {"whitelist_channels": [1, 2, 3]}
+    on_disk = {"whitelist_channels": [2, 3, 4]}  # Another process removed 1 and added 4.
+    current = {"whitelist_channels": [1, 2, 5]}  # This one removed 3 and added 5.
+    assert merge_settings(on_disk, base, current) == {"whitelist_channels": [2, 4, 5]}
+
+
+def test_concurrent_voice_channel_changes_are_both_kept():
+    base = {"voice_channels": {"1": 10, "2": 20}}
+    on_disk = {"voice_channels": {"1": 10, "2": 21, "3": 30}}
+    current = {"voice_channels": {"2": 20, "4": 40}}
+    assert merge_settings(on_disk, base, current) == {"voice_channels": {"2": 21, "3": 30, "4": 40}}
+
+
+def test_scalars_changed_in_only_one_process_keep_that_change():
+    base = {"prompt_model": "gpt-3.5-turbo", "auto_reply": False}
+    on_disk = {"prompt_model": "gpt-4", "auto_reply": False}
+    current = {"prompt_model": "gpt-3.5-turbo", "auto_reply": True}
+    assert merge_settings(on_disk, base, current) == {"prompt_model": "gpt-4", "auto_reply": True}
+
+
+def test_new_keys_are_added():
+    assert merge_settings({"a": 1}, {}, {"b": 2}) == {"a": 1, "b": 2}
+
+
+def test_two_stores_on_one_file_merge_and_pick_up_each_others_changes(tmp_path):
+    path = settings_file(tmp_path, whitelist_channels=[1])
+    first = SettingsStore(path, load_settings(path))
+    second = SettingsStore(path, load_settings(path))
+
+    first.whitelist_channel(2)
+    second.whitelist_channel(3)
+    second["prompt_model"] = "gpt-4"
+    second.save()
+    first["auto_reply"] = True
+    first.save()
+
+    on_disk = read(path)
+    assert on_disk["whitelist_channels"] == [1, 2, 3]
+    assert (on_disk["prompt_model"], on_disk["auto_reply"]) == ("gpt-4", True)
+    assert first.is_whitelisted(3) and first["prompt_model"] == "gpt-4"
+
+
+def test_changes_made_during_a_write_are_kept_and_written_next(tmp_path, monkeypatch):
+    path = settings_file(tmp_path)
+    store = SettingsStore(path, load_settings(path), save_delay=0.0)
+    writing, release = threading.Event(), threading.Event()
+    merge_and_write = settings_module._merge_and_write
+
+    def slow_merge_and_write(*args):
+        writing.set()
+        release.wait(5)
+        return merge_and_write(*args)
+
+    monkeypatch.setattr(settings_module, "_merge_and_write", slow_merge_and_write)
+
+    async def scenario():
+        store.whitelist_channel(1)
+        await asyncio.get_running_loop().run_in_executor(None, writing.wait, 5)
+        # Another process changes the file while this write is in flight.
+        with open(path) as file:
+            other = json.load(file)
+        other["prompt_model"] = "gpt-4"
+        with open(path, "w") as file:
+            json.dump(other, file)
+        store.whitelist_channel(2)
+        store["auto_reply"] = True
+        store.save()
+        release.set()
+        while store._timer is not None or store._writer is None or not store._writer.done():
+            await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    on_disk = read(path)
+    assert on_disk["whitelist_channels"] == [1, 2]
+    assert (on_disk["prompt_model"], on_disk["auto_reply"]) == ("gpt-4", True)
+    assert store["whitelist_channels"] == [1, 2] and store.is_whitelisted(2)
+    assert store["prompt_model"] == "gpt-4" and store["auto_reply"] is True
+
+
+def test_failed_writes_are_retried(tmp_path, monkeypatch):
+    path = settings_file(tmp_path)
+    store = SettingsStore(path, load_settings(path), save_delay=0.0, retry_delay=0.05)
+    merge_and_write = settings_module._merge_and_write
+    attempts = []
+
+    def failing_once(*args):
+        attempts.append(args)
+        if len(attempts) == 1:
+            raise OSError("disk full")
+        return merge_and_write(*args)
+
+    monkeypatch.setattr(settings_module, "_merge_and_write", failing_once)
+
+    async def scenario():
+        store["auto_reply"] = True
+        store.save()
+        while len(attempts) < 2 or not store._writer.done():
+            await asyncio.sleep(0.01)
+
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert read(path)["auto_reply"] is True
+    assert not store._dirty
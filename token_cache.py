@@ -0,0 +1,72 @@
+from collections import OrderedDict
+
+
+class TokenCountCache:
+    """Size-bounded LRU cache of message token counts.
+
+    Entries are keyed by encoding, message id, edit timestamp and the prompt format ("variant") the message was
+    rendered with, so an edited message or a different model's encoding is counted again.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._counts = OrderedDict()
+
+    def __len__(self):
+        return len(self._counts)
+
+    @staticmethod
+    def key(msg, enc, variant):
+        edited_at = msg.edited_at.timestamp() if msg.edited_at is not None else None
+        return enc.name, msg.id, edited_at, variant
+
+    def seed(self, msg, encoding_name, variant, tokens):
+        """Add a known token count, such as one loaded from the conversation store, without counting a lookup."""
+        edited_at = msg.edited_at.timestamp() if msg.edited_at is not None else None
+        self._counts[(encoding_name, msg.id, edited_at, variant)] = tokens
+        while len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+
+    async def count(self, messages, contents, enc, variant, tokenizer=None):
+        """Get token counts for each message's rendered content, batch-encoding the ones not cached yet.
+
+        Misses are counted by the `TokenizerPool` when one is given.
+        """
+        counts = [0] * len(messages)
+        missing = []
+        for index, msg in enumerate(messages):
+            key = self.key(msg, enc, variant)
+            cached = self._counts.get(key)
+            if cached is None:
+                missing.append((index, key))
+            else:
+                self._counts.move_to_end(key)
+                counts[index] = cached
+
+        self.hits += len(messages) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            texts = [contents[index] for index, _ in missing]
+            if tokenizer is not None:
+                encoded = await tokenizer.count(enc, texts)
+            else:
+                encoded = [len(tokens) for tokens in enc.encode_batch(texts)]
+            for (index, key), tokens in zip(missing, encoded):
+                counts[index] = tokens
+                self._counts[key] = tokens
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return counts
+
+    def stats(self):
+        """Get the hit/miss counters and current size."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._counts),
+        }
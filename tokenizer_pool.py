@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Encodings loaded in this worker process, by name.
+_encodings = {}
+_load = None
+
+
+def load_encoding_by_name(name):
+    """Load a tiktoken encoding by its name, such as "cl100k_base"."""
+    import tiktoken
+    return tiktoken.get_encoding(name)
+
+
+def _init_worker(load):
+    global _load
+    _load = load
+
+
+def _count(encoding_name, texts):
+    enc = _encodings.get(encoding_name)
+    if enc is None:
+        enc = _encodings[encoding_name] = _load(encoding_name)
+    return [len(tokens) for tokens in enc.encode_batch(texts)]
+
+
+class TokenizerPool:
+    """Counts tokens in worker processes, so tokenizing long histories doesn't stall the gateway's event loop.
+
+    Batches under `min_chars` characters are counted in this process, since shipping them to a worker costs more
+    than it saves. Larger batches are split evenly across the workers. Each worker loads an encoding by name with
+    `load` the first time it is asked for it.
+    """
+
+    def __init__(self, processes=0, min_chars=20000, load=load_encoding_by_name):
+        self.processes = processes or os.cpu_count() or 1
+        self.min_chars = min_chars
+        self.offloaded = 0
+        # Spawned rather than forked, so workers don't inherit the gateway's sockets and threads.
+        self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_worker, initargs=(load,))
+        self._broken = False
+
+    async def count(self, enc, texts):
+        """Count the tokens of each text with an encoding, in the workers if the batch is large enough."""
+        if self._broken or sum(len(text) for text in texts) < self.min_chars:
+            return [len(tokens) for tokens in enc.encode_batch(texts)]
+
+        loop = asyncio.get_running_loop()
+        size = -(-len(texts) // self.processes)
+        batches = [texts[start:start + size] for start in range(0, len(texts), size)]
+        try:
+            counts = await asyncio.gather(*(loop.run_in_executor(self._executor, _count, enc.name, batch)
+                                            for batch in batches))
+        except BrokenProcessPool as e:
+            logging.error("The tokenizer pool broke, counting tokens in-process from now on: %s", e)
+            self._broken = True
+            return [len(tokens) for tokens in enc.encode_batch(texts)]
+        self.offloaded += len(texts)
+        return [count for batch in counts for count in batch]
+
+    def warm(self, encoding_name):
+        """Start every worker and load an encoding in each. Blocks, so call it from a thread."""
+        futures = [self._executor.submit(_count, encoding_name, [""]) for _ in range(self.processes)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logging.warning("Couldn't load %s in a tokenizer worker: %s", encoding_name, e)
+                return
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
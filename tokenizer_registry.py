@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import threading
+import time
+
+from message_processing import get_encoding_for_model
+
+# The models /set_model offers.
+SUPPORTED_MODELS = (
+    "gpt-3.5-turbo",
+    "gpt-3.5-turbo-16k",
+    "gpt-3.5-turbo-16k-0613",
+    "gpt-3.5-turbo-1106",
+    "gpt-3.5-turbo-0613",
+    "gpt-3.5-turbo-0301",
+    "gpt-4",
+    "gpt-4-1106-preview",
+    "gpt-4-0613",
+    "gpt-4-0314",
+)
+
+
+class EncodingRegistry:
+    """tiktoken encodings by model name, each loaded once and shared between threads.
+
+    Loading an encoding can take seconds the first time, since tiktoken downloads it, so `warm` loads them in a
+    background thread once the bot is connected. Requests look up the encoding of whichever model is configured.
+    """
+
+    def __init__(self, load=get_encoding_for_model):
+        self._load = load
+        self._encodings = {}
+        self._lock = threading.Lock()
+
+    def get(self, model):
+        """Get a model's encoding, loading it in this thread if it isn't loaded yet."""
+        enc = self._encodings.get(model)
+        if enc is None:
+            with self._lock:
+                enc = self._encodings.get(model)
+                if enc is None:
+                    enc = self._encodings[model] = self._load(model)
+        return enc
+
+    async def get_async(self, model):
+        """Get a model's encoding, loading it in the default executor if it isn't loaded yet."""
+        enc = self._encodings.get(model)
+        if enc is not None:
+            return enc
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, model)
+
+    def warm(self, models):
+        """Load encodings for the given models, in order, logging any that fail."""
+        start = time.perf_counter()
+        for model in models:
+            try:
+                self.get(model)
+            except Exception as e:
+                logging.warning("Couldn't load the encoding for %s: %s", model, e)
+        logging.info("Loaded encodings for %d models in %.2fs", len(self._encodings), time.perf_counter() - start)